@@ -29,17 +29,27 @@
 from __future__ import with_statement
 from fnmatch import fnmatch
 from random import randrange
+import Queue
+import cStringIO
 import cookielib
 import errno
 import hashlib
 import httplib
+import mmap
 import os
 import os.path
 import re
 import shutil
+import socket
+import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import urllib
 import urllib2
+import zipfile
 
 ################################################################################
 # Constants
@@ -63,6 +73,51 @@ LOAD_NAME = False
 
 IGNORES = ('*~', '*.bak', '.*', '#*', '*.orig')
 
+MANIFEST_DIR = '.akshell'
+
+BLOB_CACHE_DIR = os.path.join(CONFIG_DIR, 'blobs')
+
+BLOB_CACHE_LIMIT = 256 * 1024 * 1024
+
+# Fraction of the limit BlobCache evicts down to once it is exceeded
+_BLOB_CACHE_LOW_WATER = 0.75
+
+# Seconds after which a BlobCache temp file is taken as left by a dead writer
+_STALE_TEMP_AGE = 24 * 60 * 60
+
+# Seconds to reuse a remote listing, None disables the cache
+REMOTE_CACHE_TTL = None
+
+_READ_BATCH_SIZE = 64
+
+_MAX_URL_LENGTH = 2000
+
+_MAX_BATCH_BYTES = 4 * 1024 * 1024
+
+_DOWNLOAD_THREADS = 4
+
+_DOWNLOAD_RETRIES = 3
+
+# A request slower than this many times the fastest one so far per
+# _CHUNK_SIZE bytes received plus the slack in seconds halves the download
+# concurrency
+_LATENCY_FACTOR = 4
+
+_LATENCY_SLACK = 0.1
+
+_CHUNK_SIZE = 64 * 1024
+
+# Directory levels a lazily listed Remote is listed ahead of the diff
+_PREFETCH_LEVELS = 2
+
+# SpillBuffer defaults: bytes of file contents kept in memory, the least
+# size of a file to spill, and the size of a temporary file mapping
+_SPILL_BUDGET = 64 * 1024 * 1024
+
+_SPILL_SIZE = 256 * 1024
+
+_SPILL_SEGMENT = 64 * 1024 * 1024
+
 ################################################################################
 # Errors
 ################################################################################
@@ -83,102 +138,262 @@ class RequestError(Error):
         Error.__init__(self, message)
         self.code = code
 
+
+class ConflictError(Error):
+    def __init__(self, routes):
+        Error.__init__(self, 'Conflicting changes: ' +
+                       ', '.join('/'.join(route) for route in routes))
+        self.routes = routes
+
 ################################################################################
 # Internals
 ################################################################################
 
-def _request(url, data=None, code=httplib.OK, headers=None, cookie=LOAD_COOKIE):
+_loaded_cookie = (None, None)
+
+
+def _load_cookie():
+    global _loaded_cookie
+    try:
+        stat = os.stat(COOKIE_PATH)
+    except OSError, error:
+        if error.errno != errno.ENOENT: raise
+        return None
+    key = (stat.st_ino, stat.st_size, stat.st_mtime)
+    if _loaded_cookie[0] != key:
+        cookie = cookielib.MozillaCookieJar(COOKIE_PATH)
+        cookie.load()
+        _loaded_cookie = (key, cookie)
+    return _loaded_cookie[1]
+
+
+def _request(url, data=None, code=httplib.OK, headers=None, cookie=LOAD_COOKIE,
+             timeout=None):
     headers = dict(headers) if headers else {}
     headers['Accept'] = 'text/plain'
     headers['User-Agent'] = 'akshell ' + __version__
     if cookie is LOAD_COOKIE:
-        cookie = cookielib.MozillaCookieJar(COOKIE_PATH)
-        try:
-            cookie.load()
-        except IOError, error:
-            if error.errno != errno.ENOENT: raise
-            cookie = None
+        cookie = _load_cookie()
     opener = urllib2.OpenerDirector()
     opener.add_handler(urllib2.ProxyHandler())
     opener.add_handler(urllib2.HTTPHandler())
     if cookie is not None:
         opener.add_handler(urllib2.HTTPCookieProcessor(cookie))
     request = urllib2.Request(url, data, headers=headers)
-    response = opener.open(request)
+    response = (opener.open(request)
+                if timeout is None else
+                opener.open(request, timeout=timeout))
     if response.code != code:
         raise RequestError(response.read(), response.code)
     return response
 
 
+DELETE = 'delete'
+CREATE = 'create'
+SAVE = 'save'
+# A save of the content of an earlier saved route; deploy_stream gets that
+# route in place of the content
+LINK = 'link'
+
+
 class Diff(object):
-    def __init__(self):
+    def __init__(self, ops=()):
         self.delete = []
         self.create = []
         self.save   = []
+        for op_ in self.record(ops):
+            pass
+
+    def record(self, ops):
+        for kind, route in ops:
+            getattr(self, kind).append(route)
+            yield kind, route
+
+    def __iter__(self):
+        for kind in (DELETE, CREATE, SAVE):
+            for route in getattr(self, kind):
+                yield kind, route
 
 
 class Entry(object):
+    def iter_diff(self, dst, clean):
+        # Walk both trees iteratively merging sorted child names, so the
+        # stream is deterministic and a delete always precedes a create or
+        # a save of the same route.
+        stack = [(self, dst, [])]
+        while stack:
+            src, dst, route = stack.pop()
+            if src is None:
+                yield DELETE, route
+            elif isinstance(src, File):
+                if isinstance(dst, File):
+                    if src._etag == dst._etag:
+                        continue
+                elif isinstance(dst, Dir):
+                    yield DELETE, route
+                yield SAVE, route
+            else:
+                # Only Tree directories carry digests, so this skip applies
+                # to Tree-to-Tree diffs alone
+                if (isinstance(dst, Dir) and src._etag is not None and
+                    src._etag == dst._etag):
+                    continue
+                if not isinstance(dst, Dir):
+                    if isinstance(dst, File):
+                        yield DELETE, route
+                    yield CREATE, route
+                    dst = None
+                elif isinstance(dst, _LazyDir):
+                    dst.prefetch(src)
+                stack.extend(reversed(
+                    list(_merge_children(src, dst, clean, route))))
+
     def diff(self, dst, clean):
-        diff = Diff()
-        if dst:
-            self._do_diff(dst, clean, diff, [])
+        return Diff(self.iter_diff(dst, clean))
+
+
+def _merge_children(src, dst, clean, route):
+    src_names = sorted(src._children)
+    dst_names = sorted(dst._children) if dst else []
+    i = j = 0
+    while i < len(src_names) or j < len(dst_names):
+        if j == len(dst_names) or (i < len(src_names) and
+                                   src_names[i] < dst_names[j]):
+            name = src_names[i]
+            yield src._children[name], None, route + [name]
+            i += 1
+        elif i == len(src_names) or dst_names[j] < src_names[i]:
+            if clean:
+                yield None, None, route + [dst_names[j]]
+            j += 1
         else:
-            self._create(diff, [])
-        return diff
+            name = src_names[i]
+            yield src._children[name], dst._children[name], route + [name]
+            i += 1
+            j += 1
+
+
+def _lookup(entry, route):
+    for name in route:
+        if not isinstance(entry, Dir):
+            return None
+        entry = entry._children.get(name)
+    return entry
 
 
 class Dir(Entry):
-    def __init__(self, children=None):
+    def __init__(self, children=None, etag=None):
         self._children = children or {}
+        self._etag = etag
 
     def add(self, name, entry):
         self._children[name] = entry
 
-    def _create(self, diff, route):
-        diff.create.append(route)
-        for name, entry in self._children.items():
-            entry._create(diff, route + [name])
-    
-    def _do_diff(self, dst, clean, diff, route):
-        if isinstance(dst, Dir):
-            for name, src_entry in self._children.items():
-                child_route = route + [name]
-                try:
-                    dst_entry = dst._children[name]
-                except KeyError:
-                    src_entry._create(diff, child_route)
-                else:
-                    src_entry._do_diff(dst_entry, clean, diff, child_route)
-            if clean:
-                for name in dst._children:
-                    if name not in self._children:
-                        diff.delete.append(route + [name])
-        else:
-            if isinstance(dst, File):
-                diff.delete.append(route)
-            self._create(diff, route)
-
 
 class File(Entry):
-    def __init__(self, etag=None):
+    def __init__(self, etag=None, size=None):
         self._etag = etag
+        self._size = size
+
+
+def _parallel_map(function, items, threads):
+    if threads <= 1 or len(items) <= 1:
+        return map(function, items)
+    results = [None] * len(items)
+    errors = []
+    stop = threading.Event()
+    queue = Queue.Queue()
+    for pair in enumerate(items):
+        queue.put(pair)
+    def work():
+        while not stop.isSet():
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(item)
+            except BaseException:
+                errors.append(sys.exc_info())
+                stop.set()
+    workers = [threading.Thread(target=work)
+               for i_ in range(min(threads, len(items)))]
+    for worker in workers:
+        worker.setDaemon(True)
+        worker.start()
+    try:
+        # Join with a timeout, a plain join() blocks KeyboardInterrupt
+        for worker in workers:
+            while worker.isAlive():
+                worker.join(0.1)
+    except BaseException:
+        stop.set()
+        raise
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def _fill(ops, contents):
+    contents = iter(contents)
+    for kind, route in ops:
+        yield kind, route, (contents.next() if kind == SAVE else None)
+
+
+class _Storage(object):
+    # Whether deploy_stream accepts LINK items
+    links = True
+
+    # Whether deploy_stream needs all DELETE items before the others
+    deletes_first = False
+
+    def traverse_subtree(self, route):
+        entry = _lookup(self.traverse(), route)
+        if entry is None:
+            raise DoesNotExistError('Entry "%s" does not exist'
+                                    % '/'.join(route))
+        return entry
+
+    def read_stream(self, ops):
+        for kind, route in ops:
+            yield kind, route, (self.read_files([route])[0]
+                                if kind == SAVE else
+                                None)
+
+    def deploy(self, diff, contents):
+        assert len(diff.save) == len(contents)
+        self.deploy_stream(_fill(diff, contents))
 
-    def _create(self, diff, route):
-        diff.save.append(route)
+    def copy_stream(self, src, ops):
+        self.deploy_stream(src.read_stream(ops))
 
-    def _do_diff(self, dst, clean, diff, route):
-        if isinstance(dst, File):
-            if self._etag == dst._etag:
-                return
-        elif isinstance(dst, Dir):
-            diff.delete.append(route)
-        diff.save.append(route)
+
+# Etags of local files by absolute path along with their size and mtime
+_local_etags = {}
 
 
-class Local(object):
-    def __init__(self, path, ignores=IGNORES):
+def _get_local_etag(path, stat):
+    key = (stat.st_size, stat.st_mtime)
+    try:
+        cached_key, etag = _local_etags[path]
+    except KeyError:
+        cached_key = None
+    if cached_key != key:
+        with open(path, 'rb') as f:
+            etag = hashlib.md5(f.read()).hexdigest()
+        _local_etags[path] = key, etag
+    return etag
+
+
+class Local(_Storage):
+    # On a case-insensitive file system a delete of "Readme" following a
+    # save of "README" would remove the saved file
+    deletes_first = True
+
+    def __init__(self, path, ignores=IGNORES, manifest=False):
         self._path = path
         self._ignores = ignores
+        self.manifest = manifest
 
     def _do_traverse(self):
         if os.path.isdir(self._path):
@@ -186,11 +401,13 @@ class Local(object):
                 dict((name, Local(os.path.join(self._path, name),
                                   self._ignores)._do_traverse())
                      for name in os.listdir(self._path)
-                     if all(not fnmatch(name, ignore)
-                            for ignore in self._ignores)))
+                     if name != MANIFEST_DIR and
+                     all(not fnmatch(name, ignore)
+                         for ignore in self._ignores)))
         else:
-            with open(self._path, 'rb') as f:
-                return File(hashlib.md5(f.read()).hexdigest())
+            path = os.path.abspath(self._path)
+            stat = os.stat(path)
+            return File(_get_local_etag(path, stat), stat.st_size)
         
     def traverse(self):
         if not os.path.exists(self._path):
@@ -198,8 +415,58 @@ class Local(object):
                                     % self._path)
         return self._do_traverse()
 
+    def traverse_subtree(self, route):
+        return Local(self._get_path(route), self._ignores).traverse()
+
     def _get_path(self, route):
         return os.path.join(self._path, *route)
+
+    def _get_manifest_path(self, key):
+        return os.path.join(self._path, MANIFEST_DIR,
+                            hashlib.md5(key).hexdigest())
+
+    def load_manifest(self, key):
+        base = {}
+        try:
+            with open(self._get_manifest_path(key)) as f:
+                for line in f:
+                    etag, size, mtime, path = line.rstrip('\n').split(' ', 3)
+                    route = tuple(path.split('/')) if path else ()
+                    base[route] = etag
+                    if size != '-':
+                        _local_etags[os.path.abspath(self._get_path(route))] = (
+                            (int(size), float(mtime)), etag)
+        except IOError, error:
+            if error.errno not in (errno.ENOENT, errno.ENOTDIR): raise
+            return None
+        return base
+
+    def save_manifest(self, key, base):
+        if not os.path.isdir(self._path):
+            return
+        path = self._get_manifest_path(key)
+        try:
+            os.mkdir(os.path.dirname(path))
+        except OSError, error:
+            if error.errno != errno.EEXIST: raise
+        lines = []
+        for route in sorted(base):
+            etag = base[route]
+            size = mtime = '-'
+            if etag != _DIR_STATE:
+                file_path = os.path.abspath(self._get_path(route))
+                try:
+                    stat = os.stat(file_path)
+                except OSError, error:
+                    if error.errno != errno.ENOENT: raise
+                    continue
+                # A local edit kept out of the base must not be cached
+                # under the base etag or the next run would miss it
+                if _get_local_etag(file_path, stat) == etag:
+                    size, mtime = stat.st_size, repr(stat.st_mtime)
+            lines.append('%s %s %s %s\n' % (etag, size, mtime, '/'.join(route)))
+        with open(path, 'w') as f:
+            f.writelines(lines)
     
     def read_files(self, routes):
         contents = []
@@ -208,22 +475,36 @@ class Local(object):
                 contents.append(f.read())
         return contents
 
-    def deploy(self, diff, contents):
-        for route in diff.delete:
+    def deploy_stream(self, items):
+        for kind, route, content in items:
             path = self._get_path(route)
-            if os.path.isdir(path):
-                shutil.rmtree(path)
+            if kind == DELETE:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            elif kind == CREATE:
+                os.mkdir(path)
+            elif kind == LINK:
+                shutil.copyfile(self._get_path(content), path)
             else:
-                os.remove(path)
-        for route in diff.create:
-            os.mkdir(self._get_path(route))
-        assert len(diff.save) == len(contents)
-        for route, content in zip(diff.save, contents):
-            with open(self._get_path(route), 'wb') as f:
-                f.write(content)
+                with open(path, 'wb') as f:
+                    f.write(content)
+                _local_etags[os.path.abspath(path)] = (
+                    (len(content), os.stat(path).st_mtime),
+                    hashlib.md5(content).hexdigest())
+
+    def copy_stream(self, src, ops):
+        if not isinstance(src, Local):
+            return _Storage.copy_stream(self, src, ops)
+        for kind, route in ops:
+            if kind == SAVE:
+                shutil.copyfile(src._get_path(route), self._get_path(route))
+            else:
+                self.deploy_stream([(kind, route, None)])
 
 
-class Buffer(object):
+class Buffer(_Storage):
     def __init__(self, data=None):
         self.data = data
 
@@ -239,6 +520,13 @@ class Buffer(object):
             raise DoesNotExistError('Buffer entry does not exist')
         return self._do_traverse()
 
+    def traverse_subtree(self, route):
+        try:
+            data = self._get(route)
+        except (KeyError, TypeError):
+            data = None
+        return Buffer(data).traverse()
+
     def _get(self, route):
         result = self.data
         for name in route:
@@ -248,19 +536,569 @@ class Buffer(object):
     def read_files(self, routes):
         return [self._get(route) for route in routes]
 
-    def deploy(self, diff, contents):
-        for route in diff.delete:
-            del self._get(route[:-1])[route[-1]]
-        for route in diff.create:
-            if route:
-                self._get(route[:-1])[route[-1]] = {}
+    def deploy_stream(self, items):
+        for kind, route, content in items:
+            if kind == DELETE:
+                del self._get(route[:-1])[route[-1]]
+            elif kind == CREATE:
+                if route:
+                    self._get(route[:-1])[route[-1]] = {}
+                else:
+                    self.data = {}
+            elif kind == LINK:
+                self._get(route[:-1])[route[-1]] = self._get(content)
             else:
-                self.data = {}
-        assert len(diff.save) == len(contents)
-        for route, content in zip(diff.save, contents):
-            self._get(route[:-1])[route[-1]] = content
+                self._get(route[:-1])[route[-1]] = content
+
+
+def _content_size(data):
+    result = 0
+    stack = [data]
+    while stack:
+        data = stack.pop()
+        if isinstance(data, dict):
+            stack.extend(data.itervalues())
+        elif isinstance(data, str):
+            result += len(data)
+    return result
+
+
+class SpillBuffer(Buffer):
+    '''Buffer keeping file contents beyond a memory budget on disk.
+
+    Once saved contents would take more than budget bytes of memory, files
+    of at least spill_size bytes are written to an anonymous memory mapped
+    temporary file. data holds read-only buffer objects over the mapping
+    for them, which are read and deployed further without copying. Space
+    of deleted spilled files is freed only with the SpillBuffer itself.
+
+    '''
+
+    def __init__(self, data=None, budget=_SPILL_BUDGET,
+                 spill_size=_SPILL_SIZE):
+        Buffer.__init__(self, data)
+        self._budget = budget
+        self._spill_size = spill_size
+        self._memory = _content_size(data)
+        self._map = None
+        self._offset = 0
+
+    def _spill(self, content):
+        size = len(content)
+        if self._map is None or self._offset + size > len(self._map):
+            f = tempfile.TemporaryFile()
+            try:
+                f.truncate(max(size, _SPILL_SEGMENT))
+                self._map = mmap.mmap(f.fileno(), max(size, _SPILL_SEGMENT))
+            finally:
+                f.close()
+            self._offset = 0
+        offset = self._offset
+        self._map[offset:offset + size] = content
+        self._offset += size
+        return buffer(self._map, offset, size)
+
+    def _account(self, items):
+        for kind, route, content in items:
+            if kind in (DELETE, SAVE):
+                try:
+                    self._memory -= _content_size(self._get(route))
+                except (KeyError, TypeError):
+                    pass
+            if kind == SAVE and isinstance(content, str):
+                if (len(content) >= self._spill_size and
+                    self._memory + len(content) > self._budget):
+                    content = self._spill(content)
+                else:
+                    self._memory += len(content)
+            yield kind, route, content
+
+    def deploy_stream(self, items):
+        Buffer.deploy_stream(self, self._account(items))
+
+
+class _TreeNode(object):
+    def __init__(self, content=None):
+        self.children = {} if content is None else None
+        self.content = content
+        self.entry = None
+
+    def get_entry(self):
+        if self.entry is None:
+            if self.children is None:
+                self.entry = File(hashlib.md5(self.content).hexdigest())
+            else:
+                children = dict((name, node.get_entry())
+                                for name, node in self.children.iteritems())
+                self.entry = Dir(
+                    children,
+                    hashlib.md5(''.join(
+                        '%s %s %s\n' % (type(children[name]).__name__,
+                                         children[name]._etag,
+                                         name)
+                        for name in sorted(children))).hexdigest())
+        return self.entry
+
+    def get_data(self):
+        if self.children is None:
+            return self.content
+        return dict((name, node.get_data())
+                    for name, node in self.children.iteritems())
+
+
+def _build_node(data):
+    if not isinstance(data, dict):
+        return _TreeNode(data)
+    node = _TreeNode()
+    for name, value in data.iteritems():
+        node.children[name] = _build_node(value)
+    return node
+
+
+class Tree(_Storage):
+    '''In-memory tree with incrementally maintained digests.
+
+    Every node caches its traversal entry; directories carry an aggregate
+    digest of their children. Changes made through write(), mkdir() and
+    remove() invalidate only the entries on the changed route, so
+    traversal cost scales with the size of an edit. Unchanged subtrees
+    are skipped by digest only when diffing against another Tree; other
+    storages carry no directory digests and are compared in full.
+
+    '''
+
+    def __init__(self, data=None):
+        self._root = None if data is None else _build_node(data)
+
+    @property
+    def data(self):
+        return None if self._root is None else self._root.get_data()
+
+    def _dirty(self, route):
+        if self._root is None:
+            raise DoesNotExistError('Tree entry does not exist')
+        node = self._root
+        node.entry = None
+        for name in route:
+            node = node.children[name]
+            node.entry = None
+        return node
+
+    def write(self, route, content):
+        if not route:
+            self._root = _TreeNode(content)
+            return
+        parent = self._dirty(route[:-1])
+        if parent.children is None:
+            raise Error('"%s" is not a directory' % '/'.join(route[:-1]))
+        parent.children[route[-1]] = _TreeNode(content)
+
+    def mkdir(self, route):
+        if not route:
+            self._root = _TreeNode()
+            return
+        parent = self._dirty(route[:-1])
+        if route[-1] not in parent.children:
+            parent.children[route[-1]] = _TreeNode()
+
+    def remove(self, route):
+        if not route:
+            self._root = None
+            return
+        del self._dirty(route[:-1]).children[route[-1]]
+
+    def traverse(self):
+        if self._root is None:
+            raise DoesNotExistError('Tree entry does not exist')
+        return self._root.get_entry()
+
+    def _get(self, route):
+        node = self._root
+        for name in route:
+            node = node.children[name]
+        return node
+
+    def traverse_subtree(self, route):
+        try:
+            return self._get(route).get_entry()
+        except (AttributeError, KeyError, TypeError):
+            raise DoesNotExistError('Tree entry "%s" does not exist'
+                                    % '/'.join(route))
+
+    def read_files(self, routes):
+        return [self._get(route).content for route in routes]
+
+    def deploy_stream(self, items):
+        for kind, route, content in items:
+            if kind == DELETE:
+                self.remove(route)
+            elif kind == CREATE:
+                self.mkdir(route)
+            elif kind == LINK:
+                self.write(route, self._get(content).content)
+            else:
+                self.write(route, content)
+
+
+def _split_member_name(name):
+    route = [part for part in name.split('/') if part and part != '.']
+    if '..' in route:
+        raise Error('Archive member "%s" points outside the archive' % name)
+    return route
+
+
+def _add_route(root, route, entry):
+    dir = root
+    for name in route[:-1]:
+        child = dir._children.get(name)
+        if not isinstance(child, Dir):
+            child = Dir()
+            dir.add(name, child)
+        dir = child
+    if not isinstance(dir._children.get(route[-1]), Dir):
+        dir.add(route[-1], entry)
+
+
+def _check_archive_items(items):
+    for kind, route, content in items:
+        if kind == DELETE or (kind == SAVE and not route):
+            raise Error('Archive can only be created from a directory')
+        yield kind, route, content
+
+
+class Archive(_Storage):
+    '''Tar or zip archive used as a source or a destination.
+
+    In "r" mode entries are hashed in one sequential pass over the archive;
+    a non-seekable tar stream keeps file contents in memory for the
+    following read. read_stream() reads all saved files in one more pass,
+    in archive order, so it holds their contents in memory. In "w" mode a
+    new archive is written from the deployed stream.
+
+    format is "zip", "tar", "gz" or "bz2", the last two being compressed
+    tars. By default it is detected in "r" mode and chosen by the path
+    extension in "w" mode, where a fileobj without a path gets a plain tar.
+    A zip fileobj must be seekable.
+
+    '''
+
+    links = False
+
+    def __init__(self, path=None, mode='r', fileobj=None, format=None):
+        assert mode in ('r', 'w') and (path or fileobj)
+        assert format in (None, 'zip', 'tar', 'gz', 'bz2')
+        self._path = path
+        self._mode = mode
+        self._fileobj = fileobj
+        self._format = format
+        self._members = None
+
+    def _is_zip(self):
+        if self._format is not None:
+            return self._format == 'zip'
+        if self._mode == 'w':
+            return (self._path or '').lower().endswith('.zip')
+        if self._path is not None:
+            return zipfile.is_zipfile(self._path)
+        # A tar stream may be unseekable, a zip never is
+        try:
+            position = self._fileobj.tell()
+        except (AttributeError, IOError):
+            return False
+        try:
+            return zipfile.is_zipfile(self._fileobj)
+        finally:
+            self._fileobj.seek(position)
+
+    def traverse(self):
+        if self._mode == 'w':
+            raise DoesNotExistError('Archive "%s" is opened for writing'
+                                    % self._path)
+        if self._path and not os.path.exists(self._path):
+            raise DoesNotExistError('Archive "%s" does not exist'
+                                    % self._path)
+        root = Dir()
+        self._members = {}
+        if self._is_zip():
+            archive = zipfile.ZipFile(self._path or self._fileobj)
+            try:
+                for info in archive.infolist():
+                    route = _split_member_name(info.filename)
+                    if not route:
+                        continue
+                    if info.filename.endswith('/'):
+                        _add_route(root, route, Dir())
+                    else:
+                        _add_route(
+                            root, route,
+                            File(hashlib.md5(
+                                archive.read(info.filename)).hexdigest()))
+                        self._members[tuple(route)] = info.filename
+            finally:
+                archive.close()
+        else:
+            stream = self._fileobj is not None
+            archive = (tarfile.open(fileobj=self._fileobj, mode='r|*')
+                       if stream else
+                       tarfile.open(self._path, 'r:*'))
+            try:
+                for info in archive:
+                    route = _split_member_name(info.name)
+                    if not route:
+                        continue
+                    if info.isdir():
+                        _add_route(root, route, Dir())
+                    elif info.isfile():
+                        content = archive.extractfile(info).read()
+                        _add_route(root, route,
+                                   File(hashlib.md5(content).hexdigest()))
+                        self._members[tuple(route)] = (content
+                                                       if stream else
+                                                       info)
+            finally:
+                archive.close()
+        return root
+
+    def read_files(self, routes):
+        if not routes:
+            return []
+        if self._members is None:
+            self.traverse()
+        if self._is_zip():
+            archive = zipfile.ZipFile(self._path or self._fileobj)
+            try:
+                return [archive.read(self._members[tuple(route)])
+                        for route in routes]
+            finally:
+                archive.close()
+        if self._fileobj is not None:
+            return [self._members[tuple(route)] for route in routes]
+        # Read in archive order, a compressed tar can't seek back cheaply
+        infos = dict((tuple(route), self._members[tuple(route)])
+                     for route in routes)
+        contents = {}
+        archive = tarfile.open(self._path, 'r:*')
+        try:
+            for key, info in sorted(infos.iteritems(),
+                                    key=lambda item: item[1].offset_data):
+                contents[key] = archive.extractfile(info).read()
+        finally:
+            archive.close()
+        return [contents[tuple(route)] for route in routes]
+
+    def read_stream(self, ops):
+        ops = list(ops)
+        return _fill(ops, self.read_files([route for kind, route in ops
+                                           if kind == SAVE]))
+
+    def _write_zip(self, items):
+        archive = zipfile.ZipFile(self._fileobj or self._path, 'w',
+                                  zipfile.ZIP_DEFLATED)
+        try:
+            for kind, route, content in items:
+                if route:
+                    name = '/'.join(route)
+                    if kind == CREATE:
+                        archive.writestr(name + '/', '')
+                    else:
+                        archive.writestr(name, content)
+        finally:
+            archive.close()
+
+    def _write_tar(self, items):
+        path = (self._path or '').lower()
+        compression = (self._format if self._format in ('gz', 'bz2') else
+                       '' if self._format == 'tar' else
+                       'gz' if path.endswith(('.gz', '.tgz')) else
+                       'bz2' if path.endswith(('.bz2', '.tbz2')) else
+                       '')
+        archive = (tarfile.open(fileobj=self._fileobj, mode='w|' + compression)
+                   if self._fileobj is not None else
+                   tarfile.open(self._path, 'w:' + compression))
+        try:
+            for kind, route, content in items:
+                if not route:
+                    continue
+                info = tarfile.TarInfo('/'.join(route))
+                info.mtime = time.time()
+                if kind == CREATE:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0755
+                    archive.addfile(info)
+                else:
+                    info.mode = 0644
+                    info.size = len(content)
+                    archive.addfile(info, cStringIO.StringIO(content))
+        finally:
+            archive.close()
+
+    def deploy_stream(self, items):
+        assert self._mode == 'w'
+        items = _check_archive_items(items)
+        if self._is_zip():
+            self._write_zip(items)
+        else:
+            self._write_tar(items)
+
+
+def _git(repo, *args):
+    process = subprocess.Popen(('git',) + args, cwd=repo,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, error = process.communicate()
+    if process.returncode:
+        raise Error(error.strip() or 'git %s failed' % args[0])
+    return output
+
+
+class GitTree(_Storage):
+    '''Commit tree of a local git repository used as a transfer source.
+
+    Trees and blobs are read from the object database, so nothing has to be
+    checked out. MD5 etags are cached by blob SHA in the repository's git
+    directory; a blob is hashed only once across all transfers.
+
+    '''
+
+    def __init__(self, repo, commit='HEAD', path=''):
+        self._repo = repo
+        self._commit = commit
+        self._path = re.sub('//+', '/', path.strip('/'))
+        self._treeish = '%s:%s' % (commit, self._path)
+        self._blobs = None
+
+    def traverse_subtree(self, route):
+        tree = GitTree(self._repo, self._commit,
+                       '/'.join(([self._path] if self._path else []) + route))
+        entry = tree.traverse()
+        if self._blobs is None:
+            self._blobs = {}
+        for key, blob in tree._blobs.iteritems():
+            self._blobs[tuple(route) + key] = blob
+        return entry
+
+    def _load_etags(self):
+        self._etags_path = os.path.join(
+            self._repo, _git(self._repo, 'rev-parse', '--git-dir').strip(),
+            'akshell-etags')
+        etags = {}
+        try:
+            with open(self._etags_path) as f:
+                for line in f:
+                    sha, sep_, etag = line.strip().partition(' ')
+                    if etag:
+                        etags[sha] = etag
+        except IOError, error:
+            if error.errno != errno.ENOENT: raise
+        return etags
+
+    def _read_blobs(self, shas):
+        process = subprocess.Popen(('git', 'cat-file', '--batch'),
+                                   cwd=self._repo,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        try:
+            for sha in shas:
+                process.stdin.write(sha + '\n')
+                process.stdin.flush()
+                header = process.stdout.readline().split()
+                if header[1:2] == ['missing']:
+                    raise Error('Git object %s is missing' % sha)
+                content = process.stdout.read(int(header[2]))
+                process.stdout.read(1)
+                yield sha, content
+        finally:
+            process.stdin.close()
+            process.wait()
+
+    def traverse(self):
+        try:
+            kind = _git(self._repo, 'cat-file', '-t', self._treeish).strip()
+        except Error:
+            raise DoesNotExistError('Git entry "%s" does not exist'
+                                    % self._treeish)
+        etags = self._load_etags()
+        if kind == 'tree':
+            lines = _git(self._repo, 'ls-tree', '-r', '-t', '-z',
+                         self._treeish).split('\0')[:-1]
+            self._blobs = {}
+            for line in lines:
+                info, path = line.split('\t', 1)
+                mode_, type, sha = info.split()
+                if type in ('tree', 'blob'):
+                    self._blobs[tuple(path.split('/'))] = (type, sha)
+        elif kind == 'blob':
+            sha = _git(self._repo, 'rev-parse', self._treeish).strip()
+            self._blobs = {(): ('blob', sha)}
+        else:
+            raise Error('Git entry "%s" is a %s' % (self._treeish, kind))
+        new_shas = sorted(set(sha
+                              for type, sha in self._blobs.itervalues()
+                              if type == 'blob' and sha not in etags))
+        if new_shas:
+            with open(self._etags_path, 'a') as f:
+                for sha, content in self._read_blobs(new_shas):
+                    etags[sha] = hashlib.md5(content).hexdigest()
+                    f.write('%s %s\n' % (sha, etags[sha]))
+        if kind == 'blob':
+            return File(etags[self._blobs[()][1]])
+        root = Dir()
+        for route in sorted(self._blobs):
+            type, sha = self._blobs[route]
+            parent = root
+            for name in route[:-1]:
+                parent = parent._children[name]
+            parent.add(route[-1], Dir() if type == 'tree' else File(etags[sha]))
+        return root
+
+    def read_files(self, routes):
+        if self._blobs is None:
+            self.traverse()
+        return [content
+                for sha_, content in self._read_blobs(
+                    [self._blobs[tuple(route)][1] for route in routes])]
+
+    def read_stream(self, ops):
+        # Feed the saves to one cat-file process as they come
+        if self._blobs is None:
+            self.traverse()
+        pending = []
+        def get_shas():
+            for op in ops:
+                pending.append(op)
+                if op[0] == SAVE:
+                    yield self._blobs[tuple(op[1])][1]
+        for sha_, content in self._read_blobs(get_shas()):
+            for kind, route in pending[:-1]:
+                yield kind, route, None
+            yield pending[-1][0], pending[-1][1], content
+            del pending[:]
+        for kind, route in pending:
+            yield kind, route, None
 
             
+def _plan_batches(routes, url_length, sizes):
+    batches = []
+    batch = []
+    length = size = 0
+    for route in routes:
+        # Each route is followed by a quoted newline separator
+        route_length = len(urllib.quote('/'.join(route))) + 3
+        route_size = sizes.get(tuple(route)) or 0
+        if batch and (url_length + length + route_length > _MAX_URL_LENGTH or
+                      size + route_size > _MAX_BATCH_BYTES or
+                      len(batch) == _READ_BATCH_SIZE):
+            batches.append(batch)
+            batch = []
+            length = size = 0
+        batch.append(route)
+        length += route_length
+        size += route_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 def _load_name():
     try:
         with open(NAME_PATH) as f:
@@ -283,15 +1121,170 @@ def _encode_multipart(fields, files):
         parts.append(
             '--%s\r\nContent-Disposition: form-data; name=%s; filename=%s\r\n'
             % (boundary, name, path))
-        parts.append(value)
+        parts.append(str(value))
     parts.append('--%s--\n' % boundary)
     return 'multipart/form-data; boundary=' + boundary, '\r\n'.join(parts)
 
 
-class Remote(object):
+# Listings by URL along with the time they were made, see REMOTE_CACHE_TTL
+_remote_trees = {}
+
+
+class Progress(object):
+    '''Counters of Remote requests and transferred bytes.'''
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.concurrency = 1
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.iteritems():
+                setattr(self, name, getattr(self, name) + count)
+
+
+class _Throttle(object):
+    def __init__(self, rate):
+        self._rate = float(rate)
+        self._lock = threading.Lock()
+        self._next_time = time.time()
+
+    def consume(self, size):
+        # Reserve a time slot for size bytes and wait for its start
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_time)
+            self._next_time = start + size / self._rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class _Window(object):
+    # Additive increase, multiplicative decrease of allowed concurrent
+    # requests driven by request latencies and errors
+    def __init__(self, limit, progress):
+        self._limit = limit
+        self._size = float(min(2, limit))
+        self._active = 0
+        self._best_cost = None
+        self._progress = progress
+        self._condition = threading.Condition()
+        progress.concurrency = int(self._size)
+
+    def run(self, function, *args, **kwds):
+        # An optional measure keyword maps the result to its size in bytes,
+        # so latencies of small and large responses compare fairly
+        measure = kwds.get('measure')
+        with self._condition:
+            while self._active >= int(self._size):
+                # Wait with a timeout to stay interruptible
+                self._condition.wait(0.1)
+            self._active += 1
+        start = time.time()
+        try:
+            result = function(*args)
+        except:
+            self._update(None, 0)
+            raise
+        self._update(time.time() - start, measure(result) if measure else 0)
+        return result
+
+    def _update(self, latency, size):
+        with self._condition:
+            self._active -= 1
+            units = max(1.0, float(size) / _CHUNK_SIZE)
+            if latency is None or (self._best_cost is not None and
+                                   latency >
+                                   _LATENCY_FACTOR * self._best_cost * units +
+                                   _LATENCY_SLACK):
+                self._size = max(1.0, self._size / 2)
+            else:
+                self._size = min(self._limit, self._size + 1 / self._size)
+            if latency is not None:
+                cost = latency / units
+                self._best_cost = (cost
+                                   if self._best_cost is None else
+                                   min(self._best_cost, cost))
+            self._progress.concurrency = int(self._size)
+            self._condition.notifyAll()
+
+
+class _ThrottledBody(object):
+    def __init__(self, data, throttle, progress):
+        self._data = data
+        self._throttle = throttle
+        self._progress = progress
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def read(self, size=-1):
+        end = len(self._data) if size < 0 else self._pos + size
+        chunk = self._data[self._pos:end]
+        self._pos += len(chunk)
+        if self._throttle:
+            self._throttle.consume(len(chunk))
+        self._progress.add(bytes_sent=len(chunk))
+        return chunk
+
+
+def _is_transient(error):
+    return (isinstance(error, (urllib2.URLError, socket.error,
+                               httplib.HTTPException)) or
+            isinstance(error, RequestError) and error.code >= 500)
+
+
+_SIZED_FILE_LINE = re.compile(r'^(.*) ([0-9a-f]{32}) (\d+)$')
+
+_ETAG = re.compile(r'^[0-9a-f]{32}$')
+
+_TEMP_BLOB = re.compile(r'^[0-9a-f]{32}\.\d+$')
+
+
+class _LazyDir(Dir):
+    '''Remote directory listed on the first access to its children.'''
+
+    def __init__(self, remote, route, children=None):
+        self._remote = remote
+        self._route = route
+        self._etag = None
+        self._listed = children
+        self._lock = threading.Lock()
+
+    @property
+    def _children(self):
+        with self._lock:
+            if self._listed is None:
+                children, sizes = self._remote._list_dir(self._route)
+                self._remote._sizes.update(sizes)
+                self._listed = children
+        return self._listed
+
+    def _subdir_pairs(self, src):
+        return [(entry, src._children[name])
+                for name, entry in self._children.iteritems()
+                if (isinstance(entry, _LazyDir) and
+                    isinstance(src._children.get(name), Dir))]
+
+    def prefetch(self, src):
+        # List subdirectories which src has too in the background
+        pairs = self._subdir_pairs(src)
+        if pairs:
+            self._remote._prefetch(pairs, _PREFETCH_LEVELS)
+
+
+class Remote(_Storage):
     def __init__(self, app_name, owner_name=LOAD_NAME, spot_name=None, path='',
-                 cookie=LOAD_COOKIE):
+                 cookie=LOAD_COOKIE, threads=_DOWNLOAD_THREADS, rate=None,
+                 timeout=None, sink=None, links=False):
         assert owner_name is not None if spot_name else not owner_name
+        assert threads >= 1
         if spot_name and owner_name is LOAD_NAME:
             owner_name = _load_name()
         self._url = (
@@ -303,15 +1296,55 @@ class Remote(object):
         if self._path:
             self._url += '/' + urllib.quote(self._path)
         self._cookie = cookie
+        self._threads = threads
+        self._throttle = _Throttle(rate) if rate else None
+        self._timeout = timeout
+        self._sink = sink
+        # Only a server accepting the "link" deploy field can take LINK items
+        self.links = links
+        self._sizes = {}
+        self.progress = Progress()
+        self._window = _Window(threads, self.progress)
+        self._prefetch_queue = Queue.Queue()
+        self._prefetch_lock = threading.Lock()
+        self._prefetchers = 0
+
+    def _request(self, url, data=None, *args):
+        if data is not None:
+            data = _ThrottledBody(data, self._throttle, self.progress)
+        self.progress.add(requests=1)
+        try:
+            return _request(url, data, *args,
+                            **{'cookie': self._cookie,
+                               'timeout': self._timeout})
+        except Exception:
+            self.progress.add(errors=1)
+            raise
 
-    def _request(self, *args):
-        return _request(*args, **{'cookie': self._cookie})
-
-    def _traverse_dir(self):
-        data = self._request(self._url + '/?etag&recursive').read()
+    def _read(self, response):
+        chunks = []
+        while True:
+            chunk = response.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            if self._throttle:
+                self._throttle.consume(len(chunk))
+            self.progress.add(bytes_received=len(chunk))
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def _get_url(self, route):
+        return (self._url + '/' + urllib.quote('/'.join(route))
+                if route else
+                self._url)
+
+    def _traverse_dir(self, route):
+        data = self._read(
+            self._request(self._get_url(route) + '/?etag&recursive'))
         lines = data.split('\r\n') if data else []
         root = Dir()
         dirs = [('', root)]
+        sizes = {}
         for line in lines:
             while not line.startswith(dirs[-1][0]):
                 dirs.pop()
@@ -323,49 +1356,324 @@ class Remote(object):
                 parent_dir.add(name, dir)
                 dirs.append((line, dir))
             else:
-                idx = line.rfind(' ')
-                name = line[len(parent_path):idx]
+                match = _SIZED_FILE_LINE.match(line)
+                if match:
+                    path, etag, size = match.group(1, 2, 3)
+                    size = int(size)
+                    sizes[tuple(route) + tuple(path.split('/'))] = size
+                else:
+                    path, sep_, etag = line.rpartition(' ')
+                    size = None
+                name = path[len(parent_path):]
                 assert '/' not in name
-                parent_dir.add(name, File(line[idx + 1:]))
-        return root
-
-    def traverse(self):
+                parent_dir.add(name, File(etag, size))
+        return root, sizes
+
+    def _list_dir(self, route):
+        # Non-recursive listing with subdirectories left unlisted
+        data = self._read(self._request(self._get_url(route) + '/?etag'))
+        children = {}
+        sizes = {}
+        for line in (data.split('\r\n') if data else []):
+            if line.endswith('/'):
+                children[line[:-1]] = _LazyDir(self, route + [line[:-1]])
+                continue
+            match = _SIZED_FILE_LINE.match(line)
+            if match:
+                name, etag, size = match.group(1, 2, 3)
+                size = int(size)
+                sizes[tuple(route) + (name,)] = size
+            else:
+                name, sep_, etag = line.rpartition(' ')
+                size = None
+            children[name] = File(etag, size)
+        return children, sizes
+
+    def _prefetch(self, pairs, levels):
+        # Up to threads workers list queued _LazyDirs and exit when idle
+        for dir, src in pairs:
+            self._prefetch_queue.put((dir, src, levels))
+        with self._prefetch_lock:
+            while self._prefetchers < self._threads:
+                worker = threading.Thread(target=self._prefetch_work)
+                worker.setDaemon(True)
+                worker.start()
+                self._prefetchers += 1
+
+    def _prefetch_work(self):
+        while True:
+            with self._prefetch_lock:
+                try:
+                    dir, src, levels = self._prefetch_queue.get_nowait()
+                except Queue.Empty:
+                    self._prefetchers -= 1
+                    return
+            try:
+                pairs = (self._window.run(dir._subdir_pairs, src)
+                         if dir._listed is None else
+                         dir._subdir_pairs(src))
+            except Exception:
+                # Left to the diff to meet
+                continue
+            if levels > 1:
+                for subdir, src_subdir in pairs:
+                    self._prefetch_queue.put((subdir, src_subdir, levels - 1))
+
+    def traverse(self, cached=True):
+        self._sizes = {}
+        return self.traverse_subtree([], cached)
+
+    def _get_cache_key(self, route):
+        # Listings are only shared within one login session
+        cookie = (_load_cookie()
+                  if self._cookie is LOAD_COOKIE else
+                  self._cookie)
+        session = (tuple(sorted((item.domain, item.name, item.value)
+                                for item in cookie))
+                   if cookie else
+                   None)
+        return session, self._get_url(route)
+
+    def traverse_subtree(self, route, cached=True):
+        '''Return the entry at route.
+
+        Unless cached is false a listing made less than REMOTE_CACHE_TTL
+        seconds ago in the same session is reused.
+
+        '''
+        key = self._get_cache_key(route)
+        if cached and REMOTE_CACHE_TTL is not None:
+            try:
+                cached_time, entry, sizes = _remote_trees[key]
+            except KeyError:
+                pass
+            else:
+                if time.time() - cached_time < REMOTE_CACHE_TTL:
+                    self._sizes.update(sizes)
+                    return entry
+        entry, sizes = self._do_traverse(route)
+        self._sizes.update(sizes)
+        if REMOTE_CACHE_TTL is not None:
+            _remote_trees[key] = time.time(), entry, sizes
+        return entry
+
+    def traverse_lazily(self, route):
+        '''Like traverse_subtree() but list each directory on demand.'''
+        entry, sizes = self._do_traverse(route, True)
+        self._sizes.update(sizes)
+        return entry
+
+    def _do_traverse(self, route, lazy=False):
         try:
-            return self._traverse_dir()
+            if lazy:
+                children, sizes = self._list_dir(route)
+                return _LazyDir(self, route, children), sizes
+            return self._traverse_dir(route)
         except RequestError, error:
             if error.code == httplib.MOVED_PERMANENTLY:
-                return File()
+                return File(), {}
             if (error.code == httplib.NOT_FOUND and
                 str(error).startswith('Entry ')):
-                raise DoesNotExistError('Remote entry "%s" does not exist'
-                                        % self._path)
+                raise DoesNotExistError(
+                    'Remote entry "%s" does not exist'
+                    % '/'.join(([self._path] if self._path else []) + route))
             raise
 
-    def read_files(self, routes):
-        if not routes:
-            return []
-        if routes == [[]]:
-            return [self._request(self._url).read()]
+    def _read_batch(self, routes):
         response = self._request(
             self._url + '/?files=' +
             urllib.quote('\n'.join('/'.join(route) for route in routes)))
         boundary = response.headers['Content-Type'].rpartition('=')[2]
-        return [part[part.find('\r\n\r\n') + 4:-4]
-                for part in response.read().split(boundary)[1:-1]]
+        contents = [part[part.find('\r\n\r\n') + 4:-4]
+                    for part in self._read(response).split(boundary)[1:-1]]
+        assert len(contents) == len(routes)
+        return contents
 
-    def deploy(self, diff, contents):
+    def _read_batch_with_retries(self, routes):
+        for attempt in range(_DOWNLOAD_RETRIES):
+            start = time.time()
+            try:
+                contents = self._window.run(
+                    self._read_batch, routes,
+                    measure=lambda contents: sum(map(len, contents)))
+                if self._sink:
+                    self._sink('batch', files=len(routes),
+                               size=sum(len(content) for content in contents),
+                               seconds=time.time() - start)
+                return contents
+            except Exception, error:
+                if attempt == _DOWNLOAD_RETRIES - 1 or not _is_transient(error):
+                    raise
+                self.progress.add(retries=1)
+
+    def read_files(self, routes):
+        if not routes:
+            return []
+        if routes == [[]]:
+            return [self._read(self._request(self._get_url([])))]
+        batches = _plan_batches(routes, len(self._url) + len('/?files='),
+                                self._sizes)
+        return [content
+                for contents in _parallel_map(self._read_batch_with_retries,
+                                              batches, self._threads)
+                for content in contents]
+
+    def read_stream(self, ops):
+        pending = []
+        routes = []
+        for op in ops:
+            pending.append(op)
+            if op[0] == SAVE:
+                routes.append(op[1])
+                if len(routes) == _READ_BATCH_SIZE * self._threads:
+                    for item in _fill(pending, self.read_files(routes)):
+                        yield item
+                    pending = []
+                    routes = []
+        for item in _fill(pending, self.read_files(routes)):
+            yield item
+
+    def deploy_stream(self, items):
+        routes = {DELETE: [], CREATE: []}
+        files = []
+        links = []
+        for kind, route, content in items:
+            if kind == SAVE:
+                files.append(('save', '/'.join(route), content))
+            elif kind == LINK:
+                links.append('/'.join(route) + '\t' + '/'.join(content))
+            else:
+                routes[kind].append(route)
         fields = ([('op', 'deploy')] +
-                  [(name, '\n'.join('/'.join(route) for route in routes))
-                   for name, routes in (('delete', diff.delete),
-                                        ('create', diff.create))
-                   if routes])
-        assert len(diff.save) == len(contents)
-        files = [('save', '/'.join(route), content)
-                 for route, content in zip(diff.save, contents)]
+                  [(kind, '\n'.join('/'.join(route) for route in routes[kind]))
+                   for kind in (DELETE, CREATE)
+                   if routes[kind]] +
+                  ([(LINK, '\n'.join(links))] if links else []))
+        if len(fields) == 1 and not files:
+            return
+        _remote_trees.clear()
         content_type, body = _encode_multipart(fields, files)
         self._request(self._url + '/', body, httplib.FOUND,
                       {'Content-Type': content_type})
-    
+
+    def copy_stream(self, src, ops):
+        # The server copies saved routes from the source URL path itself
+        if not (isinstance(src, Remote) and
+                src._url.split('/', 3)[2] == self._url.split('/', 3)[2]):
+            return _Storage.copy_stream(self, src, ops)
+        routes = {DELETE: [], CREATE: [], SAVE: []}
+        for kind, route in ops:
+            routes[kind].append(route)
+        if not any(routes.itervalues()):
+            return
+        fields = ([('op', 'copy'), ('source', '/' + src._url.split('/', 3)[3])] +
+                  [('copy' if kind == SAVE else kind,
+                    '\n'.join('/'.join(route) for route in routes[kind]))
+                   for kind in (DELETE, CREATE, SAVE)
+                   if routes[kind]])
+        _remote_trees.clear()
+        content_type, body = _encode_multipart(fields, [])
+        self._request(self._url + '/', body, httplib.FOUND,
+                      {'Content-Type': content_type})
+
+
+class BlobCache(object):
+    '''Directory of file contents named by their MD5 etags.
+
+    When the total size exceeds limit the least recently used blobs are
+    removed until it drops below a low-water mark, so eviction runs once
+    per many puts. hits and misses count get() results.
+
+    '''
+
+    def __init__(self, path=BLOB_CACHE_DIR, limit=BLOB_CACHE_LIMIT):
+        self._path = path
+        self._limit = limit
+        self._index = None
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        # Map etags to [last use time, size]; the time is kept as the blob
+        # mtime between runs
+        if self._index is not None:
+            return
+        self._index = {}
+        try:
+            names = os.listdir(self._path)
+        except OSError, error:
+            if error.errno != errno.ENOENT: raise
+            names = []
+        for name in names:
+            if _ETAG.match(name):
+                stat = os.stat(os.path.join(self._path, name))
+                self._index[name] = [stat.st_mtime, stat.st_size]
+                self._size += stat.st_size
+            elif _TEMP_BLOB.match(name):
+                # Another process may still be writing it; os.kill() can't
+                # probe the writer since on Windows it terminates the pid
+                path = os.path.join(self._path, name)
+                try:
+                    if time.time() - os.stat(path).st_mtime > _STALE_TEMP_AGE:
+                        os.remove(path)
+                except OSError, error:
+                    if error.errno != errno.ENOENT: raise
+
+    def _remove(self, etag):
+        self._size -= self._index.pop(etag)[1]
+        try:
+            os.remove(os.path.join(self._path, etag))
+        except OSError, error:
+            if error.errno != errno.ENOENT: raise
+
+    def get(self, etag):
+        self._load()
+        content = None
+        if etag in self._index:
+            path = os.path.join(self._path, etag)
+            try:
+                with open(path, 'rb') as f:
+                    content = f.read()
+            except IOError, error:
+                if error.errno != errno.ENOENT: raise
+            if content is not None and hashlib.md5(content).hexdigest() == etag:
+                now = time.time()
+                self._index[etag][0] = now
+                os.utime(path, (now, now))
+            else:
+                content = None
+                self._remove(etag)
+        if content is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return content
+
+    def put(self, etag, content):
+        self._load()
+        if etag in self._index or len(content) > self._limit:
+            return
+        try:
+            os.makedirs(self._path)
+        except OSError, error:
+            if error.errno != errno.EEXIST: raise
+        path = os.path.join(self._path, etag)
+        temp_path = '%s.%d' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.rename(temp_path, path)
+        self._index[etag] = [time.time(), len(content)]
+        self._size += len(content)
+        if self._size > self._limit:
+            low_water = self._limit * _BLOB_CACHE_LOW_WATER
+            for used_, old_etag in sorted((used, old_etag)
+                                          for old_etag, (used, size_)
+                                          in self._index.iteritems()):
+                if self._size <= low_water:
+                    break
+                self._remove(old_etag)
+
 ################################################################################
 # API
 ################################################################################
@@ -411,12 +1719,328 @@ def evaluate(app_name, spot_name, expr, cookie=LOAD_COOKIE):
     return (status == 'OK'), data
 
 
-def transfer(src, dst, clean=False):
-    src_entry = src.traverse()
+def _traverse_destination(traverse):
     try:
-        dst_entry = dst.traverse()
+        return traverse()
     except DoesNotExistError:
-        dst_entry = None
-    diff = src_entry.diff(dst_entry, clean)
-    dst.deploy(diff, src.read_files(diff.save))
+        return None
+
+
+# Manifest state of a directory; file states are their etags
+_DIR_STATE = '/'
+
+
+def _flatten(entry, route=()):
+    result = {}
+    stack = [(route, entry)] if entry is not None else []
+    while stack:
+        route, entry = stack.pop()
+        if isinstance(entry, Dir):
+            result[route] = _DIR_STATE
+            stack.extend((route + (name,), child)
+                         for name, child in entry._children.iteritems())
+        else:
+            result[route] = entry._etag
+    return result
+
+
+def _merge_ops(ops, src_states, dst_states, base, dst_entry):
+    # Keep operations which carry source side changes made since the last
+    # sync, skip those reverting destination side changes, and collect
+    # routes changed on both sides
+    kept = []
+    conflicts = []
+    skipped_dirs = set()
+    for kind, route in ops:
+        key = tuple(route)
+        if src_states.get(key) == base.get(key):
+            if kind == CREATE:
+                skipped_dirs.add(key)
+            continue
+        if any(key[:i] in skipped_dirs for i in range(len(key))):
+            unchanged = False
+        elif kind == DELETE:
+            unchanged = all(
+                base.get(sub_key) == state
+                for sub_key, state in _flatten(_lookup(dst_entry, key),
+                                               key).iteritems())
+        else:
+            unchanged = dst_states.get(key) == base.get(key)
+        if unchanged:
+            kept.append((kind, route))
+        elif not conflicts or conflicts[-1] != route:
+            conflicts.append(route)
+    if conflicts:
+        raise ConflictError(conflicts)
+    return kept
+
+
+def _apply_ops(states, ops, src_states):
+    deleted = set(tuple(route) for kind, route in ops if kind == DELETE)
+    result = dict((key, state) for key, state in states.iteritems()
+                  if not any(key[:i] in deleted
+                             for i in range(len(key) + 1)))
+    for kind, route in ops:
+        if kind != DELETE:
+            result[tuple(route)] = src_states[tuple(route)]
+    return result
+
+
+def _find_manifest(src, dst):
+    for local, other in ((src, dst), (dst, src)):
+        if (isinstance(local, Local) and local.manifest and
+            isinstance(other, Remote)):
+            return local, other._url
+    return None, None
+
+
+def _count_entries(entry):
+    files = dirs = 0
+    stack = [entry] if entry is not None else []
+    while stack:
+        entry = stack.pop()
+        if isinstance(entry, Dir):
+            dirs += 1
+            if not (isinstance(entry, _LazyDir) and entry._listed is None):
+                stack.extend(entry._children.itervalues())
+        else:
+            files += 1
+    return files, dirs
+
+
+def _traverse_with_event(traverse, side, sink):
+    entry = traverse()
+    files, dirs = _count_entries(entry)
+    sink('traversed', side=side, files=files, dirs=dirs)
+    return entry
+
+
+def _emit_ops(ops, sink):
+    for kind, route in ops:
+        sink(kind, route=route)
+        yield kind, route
+
+
+def _emit_reads(items, sink):
+    for kind, route, content in items:
+        if kind == SAVE:
+            sink('read', route=route, size=len(content))
+        yield kind, route, content
+
+
+def _link_ops(ops, src_entry, links):
+    # Turn saves of an already saved etag into LINK ops, recording their
+    # source routes in links for _link_items
+    sources = {}
+    for kind, route in ops:
+        if kind == SAVE:
+            etag = getattr(_lookup(src_entry, route), '_etag', None)
+            if etag is not None:
+                source = sources.setdefault(etag, route)
+                if source is not route:
+                    links[tuple(route)] = source
+                    yield LINK, route
+                    continue
+        yield kind, route
+
+
+def _link_items(items, links):
+    for kind, route, content in items:
+        yield kind, route, (links[tuple(route)] if kind == LINK else content)
+
+
+# Internal op kind of a save served from a BlobCache
+_CACHED = 'cached'
+
+
+def _read_cached(src, ops, src_entry, cache):
+    # Read from src only the saves whose etags are missing in cache, and
+    # store what was read
+    contents = {}
+    etags = {}
+    def uncached_ops():
+        for kind, route in ops:
+            if kind == SAVE:
+                etag = getattr(_lookup(src_entry, route), '_etag', None)
+                if etag is not None:
+                    content = cache.get(etag)
+                    if content is not None:
+                        contents[tuple(route)] = content
+                        yield _CACHED, route
+                        continue
+                    etags[tuple(route)] = etag
+            yield kind, route
+    for kind, route, content in src.read_stream(uncached_ops()):
+        if kind == _CACHED:
+            yield SAVE, route, contents.pop(tuple(route))
+        else:
+            if kind == SAVE and tuple(route) in etags:
+                cache.put(etags.pop(tuple(route)), content)
+            yield kind, route, content
+
+
+def _deletes_first(ops):
+    # Only routes are held, contents are still read as the ops are consumed
+    ops = list(ops)
+    return ([op for op in ops if op[0] == DELETE] +
+            [op for op in ops if op[0] != DELETE])
+
+
+def _normalize_paths(paths):
+    for path in paths:
+        if '..' in path.split('/'):
+            raise Error('Path "%s" must not contain ".."' % path)
+    routes = sorted(set(tuple(name for name in path.split('/')
+                              if name and name != '.')
+                        for path in paths))
+    result = []
+    for route in routes:
+        if not route:
+            return None
+        if not any(route[:len(other)] == other for other in result):
+            result.append(route)
+    return [list(route) for route in result]
+
+
+def _traverse_paths(traverse, routes, required):
+    # Graft the subtrees into a skeleton tree of their parent directories
+    root = Dir()
+    for route in routes:
+        parent = root
+        for name in route[:-1]:
+            parent = parent._children.setdefault(name, Dir())
+        try:
+            parent.add(route[-1], traverse(route))
+        except DoesNotExistError:
+            if required: raise
+    return root
+
+
+def _traverse_pair(src, dst, routes, sink, lazy=False):
+    # With lazy set the routes of a Remote destination are listed directory
+    # by directory; full trees are always listed in bulk. A cached listing
+    # of a Remote destination could miss changes deployed by others
+    if isinstance(dst, Remote):
+        traverse_dst_tree = lambda: dst.traverse(False)
+        traverse_dst_subtree = (dst.traverse_lazily
+                                if lazy else
+                                lambda route: dst.traverse_subtree(route,
+                                                                   False))
+    else:
+        traverse_dst_tree = dst.traverse
+        traverse_dst_subtree = dst.traverse_subtree
+    if routes:
+        traverse_src = lambda: _traverse_paths(src.traverse_subtree, routes,
+                                               True)
+        traverse_dst = lambda: _traverse_paths(traverse_dst_subtree, routes,
+                                               False)
+    else:
+        traverse_src = src.traverse
+        traverse_dst = lambda: _traverse_destination(traverse_dst_tree)
+    if sink:
+        traversals = [
+            lambda: _traverse_with_event(traverse_src, 'source', sink),
+            lambda: _traverse_with_event(traverse_dst, 'destination', sink),
+            ]
+    else:
+        traversals = [traverse_src, traverse_dst]
+    return _parallel_map(lambda traverse: traverse(), traversals, 2)
+
+
+def transfer(src, dst, clean=False, sink=None, paths=None, cache=None):
+    '''Make dst match src and return a Diff of the applied changes.
+
+    If paths are given only these slash separated subtrees are traversed
+    and transferred, in a single deploy; their parent directories must
+    exist in dst.
+
+    If sink is given it is called as sink(event, **fields) while the
+    transfer goes on, possibly from several threads. Events are
+    "traversed" (side, files, dirs) for each side, "delete", "create" and
+    "save" (route) for each diff operation, "read" (route, size) for each
+    file content obtained from src, and "done" (delete, create, save
+    counts) after dst is deployed.
+
+    Without a sync manifest the paths of a Remote dst are listed directory
+    by directory as the diff reaches them; its "traversed" event then
+    counts only the entries listed so far.
+
+    If dst supports links each distinct content is read from src once and
+    other files with the same etag are deployed as copies of the first. If
+    a BlobCache is given contents found in it are not read from src, the
+    read ones are put to it, and a "cache" (hits, misses) event is sent
+    before "done".
+
+    '''
+    local, key = _find_manifest(src, dst)
+    base = local.load_manifest(key) if local else None
+    routes = _normalize_paths(paths) if paths else None
+    src_entry, dst_entry = _traverse_pair(src, dst, routes, sink, not local)
+    ops = src_entry.iter_diff(dst_entry, clean)
+    if local:
+        src_states = _flatten(src_entry)
+        dst_states = _flatten(dst_entry)
+        ops = (list(ops)
+               if base is None else
+               _merge_ops(ops, src_states, dst_states, base, dst_entry))
+    if dst.deletes_first:
+        ops = _deletes_first(ops)
+    diff = Diff()
+    recorded = diff.record(_emit_ops(ops, sink) if sink else ops)
+    if dst.links:
+        links = {}
+        recorded = _link_ops(recorded, src_entry, links)
+    items = (_read_cached(src, recorded, src_entry, cache)
+             if cache else
+             src.read_stream(recorded))
+    if dst.links:
+        items = _link_items(items, links)
+    dst.deploy_stream(_emit_reads(items, sink) if sink else items)
+    if sink:
+        if cache:
+            sink('cache', hits=cache.hits, misses=cache.misses)
+        sink('done', delete=len(diff.delete), create=len(diff.create),
+             save=len(diff.save))
+    if local:
+        dst_states = _apply_ops(dst_states, ops, src_states)
+        local_states, remote_states = ((src_states, dst_states)
+                                       if local is src else
+                                       (dst_states, src_states))
+        new_base = {}
+        for route in set(local_states) | set(remote_states):
+            state = local_states.get(route)
+            if state == remote_states.get(route):
+                if state is not None:
+                    new_base[route] = state
+            elif base and route in base:
+                new_base[route] = base[route]
+        if routes and base:
+            for route, state in base.iteritems():
+                if not any(route[:len(selected)] == tuple(selected)
+                           for selected in routes):
+                    new_base.setdefault(route, state)
+        local.save_manifest(key, new_base)
+    return diff
+
+
+def copy(src, dst, clean=False, sink=None, paths=None):
+    '''Make dst match src without reading file contents on the client.
+
+    Only the listings are transferred: the diff is passed to
+    dst.copy_stream() as a plan of deletes, creates and routes to copy from
+    src, which a Remote sends to the server in one request if src is a
+    Remote too. Arguments and events are as in transfer() except that
+    there are no "read" events. Return a Diff of the applied changes.
+
+    '''
+    routes = _normalize_paths(paths) if paths else None
+    src_entry, dst_entry = _traverse_pair(src, dst, routes, sink)
+    ops = src_entry.iter_diff(dst_entry, clean)
+    if dst.deletes_first:
+        ops = _deletes_first(ops)
+    diff = Diff()
+    dst.copy_stream(src, diff.record(_emit_ops(ops, sink) if sink else ops))
+    if sink:
+        sink('done', delete=len(diff.delete), create=len(diff.create),
+             save=len(diff.save))
     return diff
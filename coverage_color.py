@@ -106,6 +106,10 @@ class Parser:
     def format(self):
         """ Parse and send the colored source.
         """
+        # collect output in memory and send it at once
+        parts = []
+        self.write = parts.append
+
         # store line offsets in self.lines
         self.lines = [0, 0]
         pos = 0
@@ -118,18 +122,19 @@ class Parser:
         # parse the source and write it
         self.pos = 0
         text = cStringIO.StringIO(self.raw)
-        self.out.write('<pre class="code">\n')
+        self.write('<pre class="code">\n')
         try:
             tokenize.tokenize(text.readline, self)
         except tokenize.TokenError, ex:
             msg = ex[0]
             line = ex[1][0]
-            self.out.write("<h3>ERROR: %s</h3>%s\n" % (
+            self.write("<h3>ERROR: %s</h3>%s\n" % (
                 msg, self.raw[self.lines[line]:]))
         if self.cover_flag:
-            self.out.write('</span>')
+            self.write('</span>')
             self.cover_flag = False
-        self.out.write('\n</pre>')
+        self.write('\n</pre>')
+        self.out.write(''.join(parts))
 
     def __call__(self, toktype, toktext, (srow,scol), (erow,ecol), line):
         """ Token handler.
@@ -144,18 +149,18 @@ class Parser:
         self.pos = newpos + len(toktext)
 
         if not self.cover_flag and srow in self.not_covered:
-            self.out.write('<span class="notcovered">')
+            self.write('<span class="notcovered">')
             self.cover_flag = True
 
         # handle newlines
         if toktype in [token.NEWLINE, tokenize.NL]:
             if self.cover_flag:
-                self.out.write('</span>')
+                self.write('</span>')
                 self.cover_flag = False
 
         # send the original whitespace, if needed
         if newpos > oldpos:
-            self.out.write(self.raw[oldpos:newpos])
+            self.write(self.raw[oldpos:newpos])
 
         # skip indenting tokens
         if toktype in [token.INDENT, token.DEDENT]:
@@ -170,28 +175,24 @@ class Parser:
         css_class = _css_classes.get(toktype, 'text')
 
         # send text
-        self.out.write('<span class="%s">' % (css_class,))
-        self.out.write(cgi.escape(toktext))
-        self.out.write('</span>')
+        self.write('<span class="%s">%s</span>'
+                   % (css_class, cgi.escape(toktext)))
 
 
 class MissingList(list):
+    """ List of "N" and "M-N" strings as reported by coverage.analysis().
+
+    Membership tests use a set of line numbers computed once.
+    """
     def __init__(self, i):
         list.__init__(self, i)
+        self.lines = set()
+        for item in self:
+            first, sep, last = item.partition('-')
+            self.lines.update(range(int(first), int(last or first) + 1))
 
     def __contains__(self, elem):
-        for i in list.__iter__(self):
-            v_ = m_ = s_ = None
-            try:
-                v_ = int(i)
-            except ValueError:
-                m_, s_ = i.split('-')
-            if v_ is not None and v_ == elem:
-                return True
-            elif (m_ is not None) and (s_ is not None) and \
-                     (int(m_) <= elem) and (elem <= int(s_)):
-                return True
-        return False
+        return elem in self.lines
 
 
 def colorize_file(filename, outstream=sys.stdout, not_covered=[]):
@@ -211,3 +212,53 @@ def colorize_file(filename, outstream=sys.stdout, not_covered=[]):
                                     not_covered.split(', ')) or \
                                    [])).format()
     outstream.write(_HTML_FOOTER)
+
+
+def _colorize_job(job):
+    filename, outname, not_covered = job
+    fo = open(outname, 'w')
+    try:
+        colorize_file(filename, fo, not_covered)
+    finally:
+        fo.close()
+
+
+def colorize_files(reports, index='coverage_index.html', processes=None):
+    """
+    Render several modules and an index page linking them.
+
+    reports is a list of (name, filename, outname, statements, missing,
+    not_covered) tuples, the last three as returned by coverage.analysis().
+    Modules are rendered in parallel when multiprocessing is available.
+    """
+    jobs = [(filename, outname, not_covered)
+            for name, filename, outname, stmts, missing, not_covered
+            in reports]
+    try:
+        import multiprocessing
+    except ImportError:
+        map(_colorize_job, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_colorize_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    parts = [_HTML_HEADER % {'title': 'modules'},
+             '<table>\n<tr><th>Module</th><th>Statements</th>'
+             '<th>Missing</th><th>Coverage</th></tr>\n']
+    for name, filename, outname, stmts, missing, not_covered in reports:
+        percent = (100.0 * (len(stmts) - len(missing)) / len(stmts)
+                   if stmts else 100.0)
+        parts.append('<tr><td><a href="%s">%s</a></td><td>%d</td>'
+                     '<td>%d</td><td>%.0f%%</td></tr>\n'
+                     % (cgi.escape(outname, True), cgi.escape(name),
+                        len(stmts), len(missing), percent))
+    parts.append('</table>\n')
+    parts.append(_HTML_FOOTER)
+    fo = open(index, 'w')
+    try:
+        fo.write(''.join(parts))
+    finally:
+        fo.close()
@@ -29,12 +29,24 @@
 
 from __future__ import with_statement
 from getpass import getpass
+import SocketServer
 import cStringIO
+import cookielib
+import hashlib
+import json
 import os.path
 import shutil
+import socket
+import stat
+import subprocess
 import sys
+import tarfile
 import tempfile
+import thread
+import threading
+import time
 import unittest
+import urllib
 import urllib2
 
 script = akshell = None # To be set in main()
@@ -152,6 +164,26 @@ class CommandTestCase(_ToolTestCase):
         self._launch('put app', input='n\n')
         self._launch('eval app 2+2', input='n\n')
         self._launch('eval 1 2 3', code=1)
+        self._launch('copy app', code=1)
+        self.assertEqual(self._launch('get --threads 0 app', code=1,
+                                      stream='stderr'),
+                         '"threads" option must be at least 1.\n')
+
+    def testJsonSink(self):
+        output = cStringIO.StringIO()
+        old_stdout = sys.stdout
+        sys.stdout = output
+        try:
+            sink = script._make_json_sink('/'.join)
+            sink('save', route=['dir', 'caf\xe9'], size=1)
+        finally:
+            sys.stdout = old_stdout
+        self.assertEqual(json.loads(output.getvalue()),
+                         {'event': 'save',
+                          'route': ['dir', u'caf\ufffd'],
+                          'path': u'dir/caf\ufffd',
+                          'size': 1,
+                          })
 
         
 def _write(path, data):
@@ -307,9 +339,957 @@ class WorkTestCase(_ToolTestCase):
         self.assertEqual(diff.delete, [['__main__.js'], ['other dir']])
         
 
+def _make_buffer_remote(data):
+    class BufferRemote(akshell.Remote):
+        def __init__(self, data):
+            self._url = 'buffer'
+            self.buffer = akshell.Buffer(data)
+        def traverse(self, cached=True):
+            return self.buffer.traverse()
+        def read_stream(self, ops):
+            return self.buffer.read_stream(ops)
+        def deploy_stream(self, items):
+            self.buffer.deploy_stream(items)
+    return BufferRemote(data)
+
+
+class DiffTestCase(unittest.TestCase):
+    def testStream(self):
+        src = akshell.Buffer({'a': 'a',
+                              'b': {'c': 'c', 'd': {}},
+                              'e': {'f': 'f'},
+                              'g': 'g',
+                              })
+        dst = akshell.Buffer({'a': 'old',
+                              'b': 'b',
+                              'e': {'f': 'f', 'x': {'y': 'y'}},
+                              'z': 'z',
+                              })
+        ops = list(src.traverse().iter_diff(dst.traverse(), True))
+        self.assertEqual(ops,
+                         [('save', ['a']),
+                          ('delete', ['b']),
+                          ('create', ['b']),
+                          ('save', ['b', 'c']),
+                          ('create', ['b', 'd']),
+                          ('delete', ['e', 'x']),
+                          ('save', ['g']),
+                          ('delete', ['z']),
+                          ])
+        diff = akshell.transfer(src, dst, True)
+        self.assertEqual(list(diff), sorted(ops, key=lambda op: (
+            ('delete', 'create', 'save').index(op[0]))))
+        self.assertEqual(dst.data, src.data)
+        self.assertEqual(list(src.traverse().iter_diff(dst.traverse(), True)),
+                         [])
+
+    def testDeep(self):
+        root = dir = akshell.Dir()
+        for i_ in range(5000):
+            child = akshell.Dir()
+            dir.add('d', child)
+            dir = child
+        dir.add('file', akshell.File('etag'))
+        diff = root.diff(None, False)
+        self.assertEqual(len(diff.create), 5001)
+        self.assertEqual(diff.save, [['d'] * 5000 + ['file']])
+
+    def testTree(self):
+        tree = akshell.Tree({'a': {'b': 'b', 'c': {'d': 'd'}}, 'e': 'e'})
+        entry = tree.traverse()
+        tree.write(['a', 'b'], 'new b')
+        tree.write(['a', 'f'], 'f')
+        new_entry = tree.traverse()
+        self.assert_(new_entry is not entry)
+        self.assert_(new_entry._children['e'] is entry._children['e'])
+        self.assert_(new_entry._children['a']._children['c'] is
+                     entry._children['a']._children['c'])
+        self.assertEqual(list(new_entry.iter_diff(entry, True)),
+                         [('save', ['a', 'b']), ('save', ['a', 'f'])])
+        dst = akshell.Tree()
+        akshell.transfer(tree, dst)
+        self.assertEqual(dst.data, tree.data)
+        self.assertEqual(dst.traverse()._etag, tree.traverse()._etag)
+        tree.remove(['a', 'c'])
+        tree.mkdir(['g'])
+        diff = akshell.transfer(tree, dst, True)
+        self.assertEqual(list(diff), [('delete', ['a', 'c']),
+                                      ('create', ['g'])])
+        self.assertEqual(dst.data, {'a': {'b': 'new b', 'f': 'f'},
+                                    'e': 'e',
+                                    'g': {},
+                                    })
+        buffer = akshell.Buffer(dst.data)
+        buffer.data['a']['b'] = 'old b'
+        self.assertEqual(list(dst.traverse().iter_diff(buffer.traverse(),
+                                                      True)),
+                         [('save', ['a', 'b'])])
+        self.assertRaises(akshell.DoesNotExistError, akshell.Tree().traverse)
+
+    def testArchive(self):
+        data = {'a': 'a', 'b': {'c': 'c', 'd': {}}}
+        dir = tempfile.mkdtemp()
+        try:
+            for name in ('app.tar.gz', 'app.zip', 'app.tar'):
+                path = os.path.join(dir, name)
+                self.assertRaises(akshell.DoesNotExistError,
+                                  akshell.Archive(path).traverse)
+                akshell.transfer(akshell.Buffer(data),
+                                 akshell.Archive(path, 'w'))
+                buffer = akshell.Buffer()
+                diff = akshell.transfer(akshell.Archive(path), buffer)
+                self.assertEqual(buffer.data, data)
+                self.assertEqual(diff.save, [['a'], ['b', 'c']])
+            with open(os.path.join(dir, 'app.tar'), 'rb') as f:
+                buffer = akshell.Buffer()
+                akshell.transfer(akshell.Archive(fileobj=f), buffer)
+                self.assertEqual(buffer.data, data)
+            stream = cStringIO.StringIO()
+            akshell.transfer(akshell.Buffer(data),
+                             akshell.Archive(mode='w', fileobj=stream))
+            stream.seek(0)
+            buffer = akshell.Buffer()
+            akshell.transfer(akshell.Archive(fileobj=stream), buffer)
+            self.assertEqual(buffer.data, data)
+            for format in ('zip', 'gz', 'bz2'):
+                stream = cStringIO.StringIO()
+                akshell.transfer(akshell.Buffer(data),
+                                 akshell.Archive(mode='w', fileobj=stream,
+                                                 format=format))
+                stream.seek(0)
+                self.assertEqual(stream.read(2) == 'PK', format == 'zip')
+                stream.seek(0)
+                buffer = akshell.Buffer()
+                akshell.transfer(akshell.Archive(fileobj=stream), buffer)
+                self.assertEqual(buffer.data, data)
+            stream = cStringIO.StringIO()
+            archive = tarfile.open(fileobj=stream, mode='w')
+            info = tarfile.TarInfo('../x')
+            info.size = 1
+            archive.addfile(info, cStringIO.StringIO('x'))
+            archive.close()
+            stream.seek(0)
+            self.assertRaises(akshell.Error,
+                              akshell.transfer,
+                              akshell.Archive(fileobj=stream), buffer)
+            many = dict(('f%d' % i, str(i)) for i in range(50))
+            opens = []
+            old_open, old_zip = akshell.tarfile.open, akshell.zipfile.ZipFile
+            def counting(function):
+                def wrapper(*args, **kwds):
+                    opens.append(args)
+                    return function(*args, **kwds)
+                return wrapper
+            for name in ('many.tar.gz', 'many.zip'):
+                path = os.path.join(dir, name)
+                akshell.transfer(akshell.Buffer(many),
+                                 akshell.Archive(path, 'w'))
+                akshell.tarfile.open = counting(old_open)
+                akshell.zipfile.ZipFile = counting(old_zip)
+                try:
+                    buffer = akshell.Buffer({})
+                    akshell.transfer(akshell.Archive(path), buffer)
+                finally:
+                    akshell.tarfile.open = old_open
+                    akshell.zipfile.ZipFile = old_zip
+                self.assertEqual(buffer.data, many)
+                self.assertEqual(len(opens), 2)
+                del opens[:]
+        finally:
+            shutil.rmtree(dir)
+
+    def testGitTree(self):
+        dir = tempfile.mkdtemp()
+        try:
+            def git(*args):
+                self.assertEqual(
+                    subprocess.call(('git',) + args, cwd=dir,
+                                    stdout=subprocess.PIPE),
+                    0)
+            git('init', '-q')
+            os.makedirs(os.path.join(dir, 'a', 'b'))
+            _write(os.path.join(dir, 'a', 'b', 'c'), 'c')
+            _write(os.path.join(dir, 'd'), 'd')
+            _write(os.path.join(dir, 'e'), 'd')
+            git('add', '.')
+            git('-c', 'user.name=test', '-c', 'user.email=test@test',
+                'commit', '-qm', 'first')
+            _write(os.path.join(dir, 'd'), 'changed')
+            buffer = akshell.Buffer()
+            akshell.transfer(akshell.GitTree(dir), buffer)
+            self.assertEqual(buffer.data,
+                             {'a': {'b': {'c': 'c'}}, 'd': 'd', 'e': 'd'})
+            self.assertEqual(
+                len(_read(os.path.join(dir, '.git', 'akshell-etags'))
+                    .splitlines()),
+                2)
+            tree = akshell.GitTree(dir, 'HEAD', 'a/b/c')
+            self.assert_(isinstance(tree.traverse(), akshell.File))
+            self.assertEqual(tree.read_files([[]]), ['c'])
+            self.assertRaises(akshell.DoesNotExistError,
+                              akshell.GitTree(dir, 'HEAD', 'no/such').traverse)
+            for i in range(20):
+                _write(os.path.join(dir, 'f%d' % i), str(i))
+            git('add', '.')
+            git('-c', 'user.name=test', '-c', 'user.email=test@test',
+                'commit', '-qm', 'second')
+            batches = []
+            old_popen = akshell.subprocess.Popen
+            def popen(args, *rest, **kwds):
+                if args[1:] == ('cat-file', '--batch'):
+                    batches.append(args)
+                return old_popen(args, *rest, **kwds)
+            akshell.subprocess.Popen = popen
+            try:
+                buffer = akshell.Buffer({})
+                akshell.transfer(akshell.GitTree(dir), buffer)
+            finally:
+                akshell.subprocess.Popen = old_popen
+            self.assertEqual(buffer.data['f7'], '7')
+            self.assertEqual(len(batches), 2)
+        finally:
+            shutil.rmtree(dir)
+
+    def testPlanBatches(self):
+        routes = [['dir', 'file%03d' % i] for i in range(300)]
+        batches = akshell._plan_batches(routes, 100, {})
+        self.assertEqual(sum(batches, []), routes)
+        for batch in batches:
+            self.assert_(len(batch) <= akshell._READ_BATCH_SIZE)
+            self.assert_(100 + len(urllib.quote('\n'.join(
+                '/'.join(route) for route in batch))) <=
+                         akshell._MAX_URL_LENGTH)
+        batches = akshell._plan_batches(
+            routes[:3], 100, {('dir', 'file001'): akshell._MAX_BATCH_BYTES + 1})
+        self.assertEqual(batches, [routes[:1], routes[1:2], routes[2:3]])
+        self.assertEqual(
+            akshell._parallel_map(lambda x: x * 2, range(100), 4),
+            range(0, 200, 2))
+        def fail(x):
+            raise ValueError(x)
+        self.assertRaises(ValueError, akshell._parallel_map, fail, [1, 2], 2)
+
+    def testConcurrentTraversal(self):
+        traversed = threading.Event()
+        class Source(akshell.Buffer):
+            def traverse(self):
+                traversed.wait(5)
+                assert traversed.isSet()
+                return akshell.Buffer.traverse(self)
+        class Destination(akshell.Buffer):
+            def traverse(self):
+                traversed.set()
+                return akshell.Buffer.traverse(self)
+        dst = Destination()
+        diff = akshell.transfer(Source({'a': 'a'}), dst)
+        self.assertEqual(diff.save, [['a']])
+        self.assertEqual(dst.data, {'a': 'a'})
+
+    def testManifest(self):
+        dir = tempfile.mkdtemp()
+        try:
+            remote = _make_buffer_remote({'old': 'old'})
+            _write(os.path.join(dir, 'a'), 'a')
+            _write(os.path.join(dir, 'b'), 'b')
+            local = akshell.Local(dir, manifest=True)
+            akshell.transfer(local, remote, True)
+            self.assertEqual(remote.buffer.data, {'a': 'a', 'b': 'b'})
+            self.assertEqual(os.listdir(os.path.join(dir, '.akshell')),
+                             [hashlib.md5('buffer').hexdigest()])
+            remote.buffer.data['b'] = 'remote b'
+            remote.buffer.data['c'] = 'remote c'
+            _write(os.path.join(dir, 'a'), 'local a')
+            diff = akshell.transfer(local, remote, True)
+            self.assertEqual(list(diff), [('save', ['a'])])
+            self.assertEqual(remote.buffer.data,
+                             {'a': 'local a', 'b': 'remote b', 'c': 'remote c'})
+            diff = akshell.transfer(remote, local, True)
+            self.assertEqual(list(diff), [('save', ['b']), ('save', ['c'])])
+            self.assertEqual(_read(os.path.join(dir, 'b')), 'remote b')
+            _write(os.path.join(dir, 'a'), 'conflict')
+            remote.buffer.data['a'] = 'other conflict'
+            os.remove(os.path.join(dir, 'c'))
+            try:
+                akshell.transfer(local, remote, True)
+            except akshell.ConflictError, error:
+                self.assertEqual(error.routes, [['a']])
+            else:
+                self.fail('ConflictError was not raised')
+            self.assertEqual(remote.buffer.data['c'], 'remote c')
+            remote.buffer.data['a'] = 'conflict'
+            diff = akshell.transfer(local, remote, True)
+            self.assertEqual(list(diff), [('delete', ['c'])])
+        finally:
+            shutil.rmtree(dir)
+
+    def testManifestLocalEdit(self):
+        dir = tempfile.mkdtemp()
+        try:
+            remote = _make_buffer_remote({})
+            local = akshell.Local(dir, manifest=True)
+            _write(os.path.join(dir, 'a'), 'a')
+            akshell.transfer(local, remote, True)
+            _write(os.path.join(dir, 'a'), 'edited a')
+            remote.buffer.data['b'] = 'b'
+            diff = akshell.transfer(remote, local, True)
+            self.assertEqual(list(diff), [('save', ['b'])])
+            diff = akshell.transfer(local, remote, True)
+            self.assertEqual(list(diff), [('save', ['a'])])
+            self.assertEqual(remote.buffer.data, {'a': 'edited a', 'b': 'b'})
+        finally:
+            shutil.rmtree(dir)
+
+    def testCaseRename(self):
+        class CaseInsensitiveLocal(akshell.Local):
+            def _get_path(self, route):
+                return os.path.join(self._path,
+                                    *[name.lower() for name in route])
+        dir = tempfile.mkdtemp()
+        try:
+            _write(os.path.join(dir, 'readme'), 'old')
+            dst = CaseInsensitiveLocal(dir)
+            dst.traverse = lambda: akshell.Buffer({'Readme': 'old'}).traverse()
+            events = []
+            diff = akshell.transfer(akshell.Buffer({'README': 'new'}), dst,
+                                    True,
+                                    lambda event, **fields:
+                                        events.append((event, fields)))
+            self.assertEqual(list(diff), [('delete', ['Readme']),
+                                          ('save', ['README'])])
+            self.assertEqual([(event, fields['route'])
+                              for event, fields in events
+                              if event in ('delete', 'save')],
+                             [('delete', ['Readme']), ('save', ['README'])])
+            self.assertEqual(_read(os.path.join(dir, 'readme')), 'new')
+        finally:
+            shutil.rmtree(dir)
+
+    def testParallelMap(self):
+        self.assertEqual(akshell._parallel_map(lambda x: x * 2, range(10), 3),
+                         range(0, 20, 2))
+        started = []
+        def fail(x):
+            started.append(x)
+            raise akshell.Error('failed %d' % x)
+        self.assertRaises(akshell.Error,
+                          akshell._parallel_map, fail, range(100), 2)
+        self.assert_(len(started) <= 2)
+        del started[:]
+        def sleep(x):
+            started.append(x)
+            time.sleep(0.5)
+        threading.Timer(0.1, thread.interrupt_main).start()
+        start = time.time()
+        self.assertRaises(KeyboardInterrupt,
+                          akshell._parallel_map, sleep, range(4), 2)
+        self.assert_(time.time() - start < 0.4)
+        time.sleep(0.6)
+        self.assertEqual(len(started), 2)
+
+    def testWindow(self):
+        progress = akshell.Progress()
+        window = akshell._Window(4, progress)
+        self.assertEqual(progress.concurrency, 2)
+        for i_ in range(10):
+            window.run(lambda: None)
+        self.assertEqual(progress.concurrency, 4)
+        self.assertRaises(ValueError, window.run, int, 'x')
+        self.assertEqual(progress.concurrency, 2)
+        throttle = akshell._Throttle(1000)
+        start = time.time()
+        for i_ in range(3):
+            throttle.consume(100)
+        self.assert_(time.time() - start >= 0.2)
+        window = akshell._Window(4, progress)
+        def update(latency, size):
+            window._active += 1
+            window._update(latency, size)
+        for i_ in range(10):
+            update(0.01, 100)
+        self.assertEqual(progress.concurrency, 4)
+        update(0.5, akshell._MAX_BATCH_BYTES)
+        self.assertEqual(progress.concurrency, 4)
+        update(5, akshell._MAX_BATCH_BYTES)
+        self.assertEqual(progress.concurrency, 2)
+
+    def testRemoteRequests(self):
+        class Response(object):
+            def __init__(self, body, headers={}):
+                self._stream = cStringIO.StringIO(body)
+                self.headers = headers
+            def read(self, size=-1):
+                return self._stream.read(size)
+        calls = []
+        failures = []
+        def request(url, data=None, code=200, headers=None, cookie=None,
+                    timeout=None):
+            calls.append((url, timeout))
+            if failures:
+                raise failures.pop(0)
+            if data is not None:
+                body = data.read(10) + data.read()
+                calls.append(body)
+                return Response('')
+            body = ''.join('--B\r\nContent-Type: text/plain\r\n\r\n%s\r\n'
+                           % content
+                           for content in ('a', 'bb'))
+            return Response(body + '--B--',
+                            {'Content-Type': 'multipart/mixed; boundary=B'})
+        old_request = akshell._request
+        akshell._request = request
+        try:
+            self.assertRaises(AssertionError,
+                              akshell.Remote, 'app', cookie=None, threads=0)
+            remote = akshell.Remote('app', cookie=None, timeout=5,
+                                    rate=10 ** 6)
+            failures.append(urllib2.URLError('refused'))
+            self.assertEqual(remote.read_files([['a'], ['b']]), ['a', 'bb'])
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(calls[-1][1], 5)
+            self.assertEqual(remote.progress.retries, 1)
+            self.assertEqual(remote.progress.errors, 1)
+            failures.append(akshell.RequestError('Not found', 404))
+            self.assertRaises(akshell.RequestError,
+                              remote.read_files, [['a'], ['b']])
+            self.assertEqual(len(calls), 3)
+            for i_ in range(akshell._DOWNLOAD_RETRIES):
+                failures.append(akshell.RequestError('Oops', 500))
+            self.assertRaises(akshell.RequestError,
+                              remote.read_files, [['a'], ['b']])
+            self.assertEqual(len(calls), 3 + akshell._DOWNLOAD_RETRIES)
+            del calls[:]
+            remote.deploy_stream([('save', ['f'], 'x' * 100)])
+            self.assert_('x' * 100 in calls[1])
+            self.assertEqual(remote.progress.bytes_sent, len(calls[1]))
+        finally:
+            akshell._request = old_request
+
+    def testEvents(self):
+        events = []
+        def sink(event, **fields):
+            events.append((event, fields))
+        dst = akshell.Buffer({'b': 'b', 'c': 'c'})
+        akshell.transfer(akshell.Buffer({'a': 'a', 'b': 'new b', 'd': {}}),
+                         dst, True, sink)
+        self.assertEqual(
+            sorted(events[:2]),
+            [('traversed', {'side': 'destination', 'files': 2, 'dirs': 1}),
+             ('traversed', {'side': 'source', 'files': 2, 'dirs': 2})])
+        self.assertEqual(events[2:],
+                         [('save', {'route': ['a']}),
+                          ('read', {'route': ['a'], 'size': 1}),
+                          ('save', {'route': ['b']}),
+                          ('read', {'route': ['b'], 'size': 5}),
+                          ('delete', {'route': ['c']}),
+                          ('create', {'route': ['d']}),
+                          ('done', {'delete': 1, 'create': 1, 'save': 2}),
+                          ])
+
+    def testPaths(self):
+        class CountingBuffer(akshell.Buffer):
+            traversed = []
+            def traverse_subtree(self, route):
+                self.traversed.append(route)
+                return akshell.Buffer.traverse_subtree(self, route)
+            def traverse(self):
+                raise AssertionError('Whole tree traversed')
+        src = CountingBuffer({'a': {'b': 'b', 'c': {'d': 'd'}},
+                              'e': {'f': 'new f', 'g': 'g'},
+                              'h': 'h',
+                              })
+        dst = CountingBuffer({'a': {'b': 'old b', 'x': 'x'},
+                              'e': {'f': 'f', 'y': 'y'},
+                              'h': 'old h',
+                              })
+        diff = akshell.transfer(src, dst, True,
+                                paths=['a/c', './e/', 'a/c/d', 'a/b'])
+        self.assertEqual(list(diff), [('delete', ['e', 'y']),
+                                      ('create', ['a', 'c']),
+                                      ('save', ['a', 'b']),
+                                      ('save', ['a', 'c', 'd']),
+                                      ('save', ['e', 'f']),
+                                      ('save', ['e', 'g']),
+                                      ])
+        self.assertEqual(dst.data, {'a': {'b': 'b', 'c': {'d': 'd'}, 'x': 'x'},
+                                    'e': {'f': 'new f', 'g': 'g'},
+                                    'h': 'old h',
+                                    })
+        self.assertEqual(sorted(CountingBuffer.traversed),
+                         [['a', 'b'], ['a', 'b'], ['a', 'c'], ['a', 'c'],
+                          ['e'], ['e']])
+        self.assertRaises(akshell.DoesNotExistError,
+                          akshell.transfer, src, dst, paths=['no'])
+        self.assertRaises(akshell.Error,
+                          akshell.transfer, src, dst, paths=['../x'])
+        self.assertRaises(akshell.Error,
+                          akshell.copy, src, dst, paths=['a/../../x'])
+        dst = CountingBuffer({'a': {}})
+        diff = akshell.transfer(src, dst, paths=['a/c'])
+        self.assertEqual(list(diff), [('create', ['a', 'c']),
+                                      ('save', ['a', 'c', 'd'])])
+
+    def testLinks(self):
+        class ReadingBuffer(akshell.Buffer):
+            read = []
+            def read_files(self, routes):
+                self.read.extend(routes)
+                return akshell.Buffer.read_files(self, routes)
+        data = {'a': 'same', 'b': {'c': 'same', 'd': 'other'}, 'e': 'same'}
+        src = ReadingBuffer(data)
+        dst = akshell.Buffer({})
+        diff = akshell.transfer(src, dst)
+        self.assertEqual(diff.save, [['a'], ['b', 'c'], ['b', 'd'], ['e']])
+        self.assertEqual(ReadingBuffer.read, [['a'], ['b', 'd']])
+        self.assertEqual(dst.data, data)
+        dir = tempfile.mkdtemp()
+        try:
+            akshell.transfer(src, akshell.Local(dir))
+            self.assertEqual(_read(os.path.join(dir, 'b', 'c')), 'same')
+            self.assertEqual(_read(os.path.join(dir, 'e')), 'same')
+        finally:
+            shutil.rmtree(dir)
+        bodies = []
+        class FakeRemote(akshell.Remote):
+            def traverse(self, cached=True):
+                return akshell.Dir()
+            def traverse_lazily(self, route):
+                return akshell.Dir()
+            def _request(self, url, data=None, *args):
+                bodies.append(data)
+        akshell.transfer(src, FakeRemote('app', links=True))
+        self.assertTrue('name=link\r\n\r\nb/c\ta\ne\ta\r\n' in bodies[0])
+        del bodies[:]
+        akshell.transfer(src, FakeRemote('app'))
+        self.assertTrue('name=link' not in bodies[0])
+        self.assertEqual(bodies[0].count('same'), 3)
+
+    def testCopy(self):
+        class UnreadLocal(akshell.Local):
+            def read_files(self, routes):
+                raise AssertionError('Contents read')
+        dir = tempfile.mkdtemp()
+        try:
+            src_path = os.path.join(dir, 'src')
+            dst_path = os.path.join(dir, 'dst')
+            os.makedirs(os.path.join(src_path, 'a'))
+            os.makedirs(os.path.join(dst_path, 'b'))
+            _write(os.path.join(src_path, 'a', 'c'), 'c')
+            _write(os.path.join(src_path, 'd'), 'd')
+            _write(os.path.join(dst_path, 'd'), 'old d')
+            diff = akshell.copy(UnreadLocal(src_path), akshell.Local(dst_path),
+                                True)
+            self.assertEqual(list(diff), [('delete', ['b']),
+                                          ('create', ['a']),
+                                          ('save', ['a', 'c']),
+                                          ('save', ['d'])])
+            self.assertEqual(sorted(os.listdir(dst_path)), ['a', 'd'])
+            self.assertEqual(_read(os.path.join(dst_path, 'a', 'c')), 'c')
+            self.assertEqual(_read(os.path.join(dst_path, 'd')), 'd')
+        finally:
+            shutil.rmtree(dir)
+        bodies = []
+        class FakeRemote(akshell.Remote):
+            def traverse(self, cached=True):
+                return (akshell.Dir({'a': akshell.File('1' * 32)})
+                        if self._path == 'src' else
+                        akshell.Dir({'x': akshell.Dir()}))
+            def _request(self, url, data=None, *args):
+                bodies.append(data)
+        diff = akshell.copy(FakeRemote('app', path='src'),
+                            FakeRemote('other', 'me', 'spot', 'dst'), True)
+        self.assertEqual(list(diff), [('delete', ['x']), ('save', ['a'])])
+        self.assertEqual(len(bodies), 1)
+        for field in ('name=op\r\n\r\ncopy\r\n',
+                      'name=source\r\n\r\n/apps/app/code/src\r\n',
+                      'name=delete\r\n\r\nx\r\n',
+                      'name=copy\r\n\r\na\r\n'):
+            self.assertTrue(field in bodies[0])
+        dst = akshell.Buffer({})
+        akshell.copy(akshell.Buffer({'a': {'b': 'b'}}), dst)
+        self.assertEqual(dst.data, {'a': {'b': 'b'}})
+
+    def testSpillBuffer(self):
+        src = akshell.Buffer({'small': 'x' * 10,
+                              'big': 'a' * 100,
+                              'dir': {'bigger': 'b' * 200},
+                              })
+        dst = akshell.SpillBuffer({}, budget=50, spill_size=50)
+        akshell.transfer(src, dst)
+        spilled = [type(dst.data[name]) is buffer for name in ('small', 'big')]
+        spilled.append(type(dst.data['dir']['bigger']) is buffer)
+        self.assertEqual(spilled, [False, True, True])
+        contents = dst.read_files([['big'], ['dir', 'bigger']])
+        self.assertEqual(map(str, contents), ['a' * 100, 'b' * 200])
+        self.assertEqual(dst.traverse()._children['big']._etag,
+                         hashlib.md5('a' * 100).hexdigest())
+        copy = akshell.Buffer({})
+        akshell.transfer(dst, copy)
+        self.assertEqual(str(copy.data['dir']['bigger']), 'b' * 200)
+        src.data['big'] = 'c' * 60
+        src.data['small'] = 'y' * 20
+        del src.data['dir']
+        self.assertEqual(list(akshell.transfer(src, dst, True)),
+                         [('delete', ['dir']),
+                          ('save', ['big']),
+                          ('save', ['small'])])
+        self.assertEqual(str(dst.data['big']), 'c' * 60)
+        self.assertEqual(dst._memory, 20)
+        dir = tempfile.mkdtemp()
+        try:
+            akshell.transfer(akshell.Buffer({'f': 'f' * 100}), dst, True)
+            akshell.transfer(dst, akshell.Local(dir))
+            self.assertEqual(_read(os.path.join(dir, 'f')), 'f' * 100)
+        finally:
+            shutil.rmtree(dir)
+
+    def testLazyListing(self):
+        listed = []
+        class ListingRemote(akshell.Remote):
+            data = {'a': {'x': {'deep': {'f': '1'}}, 'y': 'y'},
+                    'big': dict(('d%d' % i, {'f': 'f'}) for i in range(10)),
+                    }
+            def _request(self, url, data=None, *args):
+                if data is not None:
+                    return
+                path, query = url[len(self._url):].split('?')
+                path = path.strip('/')
+                listed.append((path, query))
+                route = [name for name in path.split('/') if name]
+                lines = []
+                def list_dir(prefix, dir):
+                    for name, entry in sorted(dir.items()):
+                        if isinstance(entry, dict):
+                            lines.append(prefix + name + '/')
+                            if query == 'etag&recursive':
+                                list_dir(prefix + name + '/', entry)
+                        else:
+                            lines.append('%s%s %s %d' % (
+                                prefix, name, hashlib.md5(entry).hexdigest(),
+                                len(entry)))
+                list_dir('', akshell.Buffer(self.data)._get(route))
+                return cStringIO.StringIO('\r\n'.join(lines))
+        src = akshell.Buffer({'a': {'x': {'deep': {'f': '2'}}, 'y': 'y'}})
+        dst = ListingRemote('app')
+        diff = akshell.transfer(src, dst)
+        self.assertEqual(list(diff), [('save', ['a', 'x', 'deep', 'f'])])
+        self.assertEqual(listed, [('', 'etag&recursive')])
+        del listed[:]
+        events = []
+        src.data['a']['x']['deep']['f'] = '3'
+        diff = akshell.transfer(src, dst, paths=['a'],
+                                sink=lambda event, **fields:
+                                    events.append((event, fields)))
+        self.assertEqual(list(diff), [('save', ['a', 'x', 'deep', 'f'])])
+        self.assertEqual(sorted(listed), [('a', 'etag'),
+                                          ('a/x', 'etag'),
+                                          ('a/x/deep', 'etag')])
+        self.assertEqual(dst._sizes[('a', 'x', 'deep', 'f')], 1)
+        self.assertTrue(('traversed', {'side': 'destination',
+                                       'files': 1, 'dirs': 3}) in events)
+        for i_ in range(100):
+            if not dst._prefetchers:
+                break
+            time.sleep(0.01)
+        self.assertEqual(dst._prefetchers, 0)
+
+    def testBlobCache(self):
+        class ReadingBuffer(akshell.Buffer):
+            read = []
+            def read_files(self, routes):
+                self.read.extend(routes)
+                return akshell.Buffer.read_files(self, routes)
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'blobs')
+            src = ReadingBuffer({'a': 'aaaa', 'b': 'bbbb', 'c': 'aaaa'})
+            cache = akshell.BlobCache(path, 10)
+            akshell.transfer(src, akshell.Buffer({}), cache=cache)
+            self.assertEqual(ReadingBuffer.read, [['a'], ['b']])
+            self.assertEqual((cache.hits, cache.misses), (0, 2))
+            self.assertEqual(sorted(os.listdir(path)),
+                             sorted([hashlib.md5('aaaa').hexdigest(),
+                                     hashlib.md5('bbbb').hexdigest()]))
+            del ReadingBuffer.read[:]
+            events = []
+            cache = akshell.BlobCache(path, 11)
+            dst = akshell.Buffer({})
+            akshell.transfer(src, dst, cache=cache,
+                             sink=lambda event, **fields:
+                                 events.append((event, fields)))
+            self.assertEqual(dst.data, src.data)
+            self.assertEqual(ReadingBuffer.read, [])
+            self.assertTrue(('cache', {'hits': 2, 'misses': 0}) in events)
+            time.sleep(0.01)
+            cache.get(hashlib.md5('aaaa').hexdigest())
+            cache.put(hashlib.md5('cccc').hexdigest(), 'cccc')
+            self.assertEqual(sorted(os.listdir(path)),
+                             sorted([hashlib.md5('aaaa').hexdigest(),
+                                     hashlib.md5('cccc').hexdigest()]))
+            _write(os.path.join(path, hashlib.md5('aaaa').hexdigest()), 'bad')
+            cache = akshell.BlobCache(path, 10)
+            self.assertEqual(cache.get(hashlib.md5('aaaa').hexdigest()), None)
+            self.assertEqual(cache.get(hashlib.md5('cccc').hexdigest()), 'cccc')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual(os.listdir(path), [hashlib.md5('cccc').hexdigest()])
+            stale = hashlib.md5('dddd').hexdigest() + '.123'
+            live = '%s.%d' % (hashlib.md5('eeee').hexdigest(), os.getpid())
+            _write(os.path.join(path, stale), 'dddd')
+            _write(os.path.join(path, live), 'ee')
+            old = time.time() - akshell._STALE_TEMP_AGE - 1
+            os.utime(os.path.join(path, stale), (old, old))
+            cache = akshell.BlobCache(path, 10)
+            cache.get(hashlib.md5('cccc').hexdigest())
+            self.assertEqual(sorted(os.listdir(path)),
+                             sorted([hashlib.md5('cccc').hexdigest(), live]))
+            os.remove(os.path.join(path, live))
+            cache = akshell.BlobCache(path, 100)
+            for i in range(100):
+                cache.put(hashlib.md5(str(i)).hexdigest(), 'x' * 10)
+                self.assert_(cache._size <= 100)
+            self.assertEqual(len(os.listdir(path)), 9)
+        finally:
+            shutil.rmtree(dir)
+
+    def testLoadCookie(self):
+        dir = tempfile.mkdtemp()
+        old_path = akshell.COOKIE_PATH
+        akshell.COOKIE_PATH = os.path.join(dir, 'cookie')
+        try:
+            self.assertEqual(akshell._load_cookie(), None)
+            cookielib.MozillaCookieJar(akshell.COOKIE_PATH).save()
+            cookie = akshell._load_cookie()
+            self.assert_(cookie is not None)
+            self.assert_(akshell._load_cookie() is cookie)
+            with open(akshell.COOKIE_PATH, 'a') as f:
+                f.write('\n')
+            self.assert_(akshell._load_cookie() is not cookie)
+        finally:
+            akshell.COOKIE_PATH = old_path
+            shutil.rmtree(dir)
+
+    def testLocalEtags(self):
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'file')
+            _write(path, 'content')
+            etag = akshell.Local(path).traverse()._etag
+            self.assertEqual(etag, hashlib.md5('content').hexdigest())
+            key, cached_etag_ = akshell._local_etags[os.path.abspath(path)]
+            akshell._local_etags[os.path.abspath(path)] = key, 'cached'
+            self.assertEqual(akshell.Local(path).traverse()._etag, 'cached')
+            _write(path, 'changed content')
+            self.assertEqual(akshell.Local(path).traverse()._etag,
+                             hashlib.md5('changed content').hexdigest())
+        finally:
+            shutil.rmtree(dir)
+
+    def testRemoteCache(self):
+        listed = []
+        class ListingRemote(akshell.Remote):
+            def _request(self, url, data=None, *args):
+                if data is None:
+                    listed.append(url)
+                    return cStringIO.StringIO('f %s 1' %
+                                              hashlib.md5('f').hexdigest())
+        old_ttl = akshell.REMOTE_CACHE_TTL
+        akshell.REMOTE_CACHE_TTL = 10
+        akshell._remote_trees.clear()
+        try:
+            remote = ListingRemote('app', cookie=None)
+            remote.traverse()
+            remote.traverse()
+            self.assertEqual(len(listed), 1)
+            jar = cookielib.CookieJar()
+            jar.set_cookie(cookielib.Cookie(
+                0, 'session', 'other', None, False, akshell.SERVER, False,
+                False, '/', True, False, None, False, None, None, {}))
+            ListingRemote('app', cookie=jar).traverse()
+            self.assertEqual(len(listed), 2)
+            akshell.transfer(akshell.Buffer({'f': 'f'}), remote)
+            self.assertEqual(len(listed), 3)
+            akshell.REMOTE_CACHE_TTL = 0
+            remote.traverse()
+            self.assertEqual(len(listed), 4)
+        finally:
+            akshell.REMOTE_CACHE_TTL = old_ttl
+            akshell._remote_trees.clear()
+
+
+class DaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._handlers = dict(script.command_handlers)
+        def echo_command(args):
+            print ' '.join(args)
+            sys.stderr.write('err\n')
+            print raw_input()
+        def fail_command(args):
+            raise ValueError('boom')
+        def exit_command(args):
+            sys.exit(3)
+        script.command_handlers.update({'echo': echo_command,
+                                        'fail': fail_command,
+                                        'exit': exit_command,
+                                        })
+
+    def tearDown(self):
+        script.command_handlers.clear()
+        script.command_handlers.update(self._handlers)
+        shutil.rmtree(self._dir)
+
+    def _serve(self, args, input=''):
+        # Run _DaemonHandler over a socket pair and collect the frames
+        server_sock, client_sock = socket.socketpair()
+        thread = threading.Thread(target=script._DaemonHandler,
+                                  args=(server_sock, None, None))
+        thread.start()
+        try:
+            script._send(client_sock, 'r', '\0'.join([self._dir] + args))
+            stream = client_sock.makefile('rb')
+            frames = []
+            while True:
+                kind, data = script._receive(stream)
+                if kind == 'i':
+                    script._send(client_sock, 'i', input)
+                else:
+                    frames.append((kind, data))
+                if kind == 'x':
+                    return frames
+        finally:
+            thread.join()
+            client_sock.close()
+            server_sock.close()
+
+    def testSocketMode(self):
+        modes = []
+        def serve_forever(server):
+            modes.append(stat.S_IMODE(os.stat(script.SOCKET_PATH).st_mode))
+        old_path, old_dir = script.SOCKET_PATH, akshell.CONFIG_DIR
+        old_ttl = akshell.REMOTE_CACHE_TTL
+        old_serve = SocketServer.ThreadingUnixStreamServer.serve_forever
+        old_umask = os.umask(022)
+        script.SOCKET_PATH = os.path.join(self._dir, 'daemon')
+        akshell.CONFIG_DIR = self._dir
+        SocketServer.ThreadingUnixStreamServer.serve_forever = serve_forever
+        try:
+            script.daemon_command([])
+            self.assertEqual(os.umask(022), 022)
+        finally:
+            SocketServer.ThreadingUnixStreamServer.serve_forever = old_serve
+            script.SOCKET_PATH, akshell.CONFIG_DIR = old_path, old_dir
+            akshell.REMOTE_CACHE_TTL = old_ttl
+            os.umask(old_umask)
+        self.assertEqual(modes, [0700])
+        self.assertFalse(os.path.exists(os.path.join(self._dir, 'daemon')))
+
+    def testFraming(self):
+        a, b = socket.socketpair()
+        try:
+            script._send(a, 'o', 'some\ndata')
+            script._send(a, 'x')
+            a.close()
+            stream = b.makefile('rb')
+            self.assertEqual(script._receive(stream), ('o', 'some\ndata'))
+            self.assertEqual(script._receive(stream), ('x', ''))
+            self.assertRaises(EOFError, script._receive, stream)
+        finally:
+            b.close()
+
+    def testHandler(self):
+        old_cwd = os.getcwd()
+        frames = self._serve(['echo', 'a', 'b'], 'typed\n')
+        self.assertEqual(os.getcwd(), old_cwd)
+        self.assertEqual(''.join(data for kind, data in frames if kind == 'o'),
+                         'a b\ntyped\n')
+        self.assertEqual(''.join(data for kind, data in frames if kind == 'e'),
+                         'err\n')
+        self.assertEqual(frames[-1], ('x', '0'))
+        self.assertEqual(self._serve(['exit'])[-1], ('x', '3'))
+        frames = self._serve(['fail'])
+        self.assertEqual(frames[-1], ('x', '1'))
+        self.assertTrue('ValueError: boom' in
+                        ''.join(data for kind, data in frames if kind == 'e'))
+        self.assertEqual(self._serve(['no_such_command'])[-1], ('x', '1'))
+
+    def testForward(self):
+        old_path = script.SOCKET_PATH
+        script.SOCKET_PATH = os.path.join(self._dir, 'daemon')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        received = []
+        def serve():
+            sock = listener.accept()[0]
+            stream = sock.makefile('rb')
+            received.append(script._receive(stream))
+            script._send(sock, 'o', 'out\n')
+            script._send(sock, 'i')
+            received.append(script._receive(stream))
+            script._send(sock, 'x', '2')
+            sock.close()
+        old_stdout, old_stdin = sys.stdout, sys.stdin
+        try:
+            self.assertEqual(script._forward(['echo']), None)
+            listener.bind(script.SOCKET_PATH)
+            listener.listen(1)
+            thread = threading.Thread(target=serve)
+            thread.start()
+            sys.stdout = cStringIO.StringIO()
+            sys.stdin = cStringIO.StringIO('line\n')
+            code = script._forward(['echo', 'x'])
+            output = sys.stdout.getvalue()
+            thread.join()
+        finally:
+            sys.stdout, sys.stdin = old_stdout, old_stdin
+            script.SOCKET_PATH = old_path
+            listener.close()
+        self.assertEqual(code, 2)
+        self.assertEqual(output, 'out\n')
+        self.assertEqual(received,
+                         [('r', '\0'.join([os.getcwd(), 'echo', 'x'])),
+                          ('i', 'line\n')])
+
+
+class CoverageColorTestCase(unittest.TestCase):
+    def testMissingList(self):
+        import coverage_color
+        missing = coverage_color.MissingList(['3-5', '7'])
+        self.assertEqual(list(missing), ['3-5', '7'])
+        self.assertEqual([line for line in range(1, 10) if line in missing],
+                         [3, 4, 5, 7])
+        self.assertFalse(1 in coverage_color.MissingList([]))
+
+    def testColorizeFiles(self):
+        import coverage_color
+        dir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(dir, 'module.py')
+            _write(source, 'x = 1\nif x:\n    y = 2\n')
+            outname = os.path.join(dir, 'coverage_module.html')
+            index = os.path.join(dir, 'index.html')
+            coverage_color.colorize_files(
+                [('module', source, outname, [1, 2, 3], [3], '3'),
+                 ('empty', source, os.path.join(dir, 'empty.html'), [], [],
+                  '')],
+                index, 1)
+            with open(outname) as f:
+                html = f.read()
+            self.assert_('<title>code coverage of module.py</title>' in html)
+            self.assertEqual(html.count('<span class="notcovered">'), 1)
+            with open(index) as f:
+                html = f.read()
+            self.assert_('<tr><td><a href="%s">module</a></td>'
+                         '<td>3</td><td>1</td><td>67%%</td></tr>' % outname
+                         in html)
+            self.assert_('<td>0</td><td>0</td><td>100%</td>' in html)
+        finally:
+            shutil.rmtree(dir)
+
+
 def suite():
     result = unittest.TestSuite()
     result.addTest(unittest.makeSuite(CommandTestCase))
+    result.addTest(unittest.makeSuite(DiffTestCase))
+    result.addTest(unittest.makeSuite(DaemonTestCase))
+    result.addTest(unittest.makeSuite(CoverageColorTestCase))
     result.addTest(unittest.makeSuite(WorkTestCase))
     return result
 
@@ -346,10 +1326,13 @@ sudo easy_install coverage
     finally:
         if coverage:
             coverage.stop()
+            reports = []
             for module in (akshell, script):
-                path, stmts_, missing_, missing_str = coverage.analysis(module)
-                with open('coverage_%s.html' % module.__name__, 'w') as f:
-                    coverage_color.colorize_file(path, f, missing_str)
+                path, stmts, missing, missing_str = coverage.analysis(module)
+                reports.append((module.__name__, path,
+                                'coverage_%s.html' % module.__name__,
+                                stmts, missing, missing_str))
+            coverage_color.colorize_files(reports)
             coverage.report([akshell, script], show_missing=False)
             coverage.erase()
             